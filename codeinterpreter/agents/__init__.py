@@ -1,3 +1,4 @@
 from .custom_functions_agent import CustomOpenAIFunctionsAgent
+from .parallel_executor import ParallelAgentExecutor
 
-__all__ = ["CustomOpenAIFunctionsAgent"]
+__all__ = ["CustomOpenAIFunctionsAgent", "ParallelAgentExecutor"]
@@ -3,11 +3,8 @@ import json
 from json import JSONDecodeError
 from typing import Any, List, Optional, Sequence, Tuple, Union
 
-from langchain.agents import BaseSingleActionAgent
+from langchain.agents import BaseMultiActionAgent
 from langchain.agents.agent import AgentOutputParser
-from langchain.agents.format_scratchpad.openai_functions import (
-    format_to_openai_functions,
-)
 from langchain.callbacks.base import BaseCallbackManager
 from langchain.callbacks.manager import Callbacks  # type: ignore
 from langchain.chat_models.openai import ChatOpenAI
@@ -17,7 +14,7 @@ from langchain.prompts.chat import (
     HumanMessagePromptTemplate,
     MessagesPlaceholder,
 )
-from langchain.pydantic_v1 import root_validator
+from langchain.pydantic_v1 import Field, root_validator
 from langchain.schema import (
     AgentAction,
     AgentFinish,
@@ -33,6 +30,8 @@ from langchain.schema.output import ChatGeneration, Generation
 from langchain.tools.base import BaseTool
 from langchain.tools.render import format_tool_to_openai_function
 
+from .scratchpad import AgentScratchpad
+
 
 class OpenAIFunctionsAgentOutputParser(AgentOutputParser):
     """Parses a message into agent action/finish.
@@ -41,7 +40,8 @@ class OpenAIFunctionsAgentOutputParser(AgentOutputParser):
     function_call parameter from OpenAI to convey what tools to use.
 
     If a function_call parameter is passed, then that is used to get
-    the tool and tool input.
+    the tool and tool input. If the message calls several tools at once
+    (tool_calls), there is one action per call.
 
     If one is not passed, then the AIMessage is assumed to be the final output.
     """
@@ -51,68 +51,100 @@ class OpenAIFunctionsAgentOutputParser(AgentOutputParser):
         return "openai-functions-agent"
 
     @staticmethod
-    def _parse_ai_message(message: BaseMessage) -> Union[AgentAction, AgentFinish]:
+    def _parse_ai_message(message: BaseMessage) -> Union[List[AgentAction], AgentFinish]:
         """Parse an AI message."""
         if not isinstance(message, AIMessage):
             raise TypeError(f"Expected an AI message got {type(message)}")
 
+        tool_calls = message.additional_kwargs.get("tool_calls")
+        if tool_calls:
+            # one action per call, each logged as if the model had made it on
+            # its own, so the scratchpad can keep using `function_call` messages
+            return [
+                OpenAIFunctionsAgentOutputParser._parse_function_call(
+                    call["function"], message.content if i == 0 else ""
+                )
+                for i, call in enumerate(tool_calls)
+            ]
+
         function_call = message.additional_kwargs.get("function_call", {})
 
         if function_call:
-            function_name = function_call["name"]
-            try:
-                _tool_input = json.loads(function_call["arguments"])
-            except JSONDecodeError:
-                if function_name == "python":
-                    code = function_call["arguments"]
-                    _tool_input = {
-                        "code": code,
-                    }
-                else:
-                    raise OutputParserException(
-                        f"Could not parse tool input: {function_call} because "
-                        f"the `arguments` is not valid JSON."
-                    )
-
-            # HACK HACK HACK:
-            # The code that encodes tool input into Open AI uses a special variable
-            # name called `__arg1` to handle old style tools that do not expose a
-            # schema and expect a single string argument as an input.
-            # We unpack the argument here if it exists.
-            # Open AI does not support passing in a JSON array as an argument.
-            if "__arg1" in _tool_input:
-                tool_input = _tool_input["__arg1"]
-            else:
-                tool_input = _tool_input
-
-            content_msg = f"responded: {message.content}\n" if message.content else "\n"
-            log = f"\nInvoking: `{function_name}` with `{tool_input}`\n{content_msg}\n"
-            return AgentActionMessageLog(
-                tool=function_name,
-                tool_input=tool_input,
-                log=log,
-                message_log=[message],
-            )
+            return [
+                OpenAIFunctionsAgentOutputParser._parse_function_call(
+                    function_call, message.content, message
+                )
+            ]
 
         return AgentFinish(
             return_values={"output": message.content}, log=message.content
         )
 
-    def parse_result(self, result: List[Generation]) -> Union[AgentAction, AgentFinish]:
+    @staticmethod
+    def _parse_function_call(
+        function_call: dict, content: str, message: Optional[AIMessage] = None
+    ) -> AgentActionMessageLog:
+        function_name = function_call["name"]
+        try:
+            _tool_input = json.loads(function_call["arguments"])
+        except JSONDecodeError:
+            if function_name == "python":
+                code = function_call["arguments"]
+                _tool_input = {
+                    "code": code,
+                }
+            else:
+                raise OutputParserException(
+                    f"Could not parse tool input: {function_call} because "
+                    f"the `arguments` is not valid JSON."
+                )
+
+        # HACK HACK HACK:
+        # The code that encodes tool input into Open AI uses a special variable
+        # name called `__arg1` to handle old style tools that do not expose a
+        # schema and expect a single string argument as an input.
+        # We unpack the argument here if it exists.
+        # Open AI does not support passing in a JSON array as an argument.
+        if "__arg1" in _tool_input:
+            tool_input = _tool_input["__arg1"]
+        else:
+            tool_input = _tool_input
+
+        if message is None:
+            message = AIMessage(
+                content=content,
+                additional_kwargs={"function_call": {
+                    "name": function_name, "arguments": function_call["arguments"],
+                }},
+            )
+        content_msg = f"responded: {content}\n" if content else "\n"
+        log = f"\nInvoking: `{function_name}` with `{tool_input}`\n{content_msg}\n"
+        return AgentActionMessageLog(
+            tool=function_name,
+            tool_input=tool_input,
+            log=log,
+            message_log=[message],
+        )
+
+    def parse_result(self, result: List[Generation]) -> Union[List[AgentAction], AgentFinish]:
         if not isinstance(result[0], ChatGeneration):
             raise ValueError("This output parser only works on ChatGeneration output")
         message = result[0].message
         return self._parse_ai_message(message)
 
-    def parse(self, text: str) -> Union[AgentAction, AgentFinish]:
+    def parse(self, text: str) -> Union[List[AgentAction], AgentFinish]:
         raise ValueError("Can only parse messages")
 
 
-class CustomOpenAIFunctionsAgent(BaseSingleActionAgent):
+class CustomOpenAIFunctionsAgent(BaseMultiActionAgent):
 
     llm: BaseLanguageModel
     tools: Sequence[BaseTool]
     prompt: BasePromptTemplate
+    scratchpad: AgentScratchpad = Field(default_factory=AgentScratchpad)
+
+    class Config:
+        arbitrary_types_allowed = True
 
     def get_allowed_tools(self) -> List[str]:
         """Get allowed tools."""
@@ -143,13 +175,23 @@ class CustomOpenAIFunctionsAgent(BaseSingleActionAgent):
     def functions(self) -> List[dict]:
         return [dict(format_tool_to_openai_function(t)) for t in self.tools]
 
+    def _messages(
+        self, intermediate_steps: List[Tuple[AgentAction, str]], kwargs: dict
+    ) -> List[BaseMessage]:
+        selected_inputs = {
+            k: kwargs[k] for k in self.prompt.input_variables if k != "agent_scratchpad"
+        }
+        return self.scratchpad.prompt_messages(
+            self.prompt, selected_inputs, intermediate_steps
+        )
+
     def plan(
         self,
         intermediate_steps: List[Tuple[AgentAction, str]],
         callbacks: Callbacks = None,
         with_functions: bool = True,
         **kwargs: Any,
-    ) -> Union[AgentAction, AgentFinish]:
+    ) -> Union[List[AgentAction], AgentFinish]:
         """Given input, decided what to do.
 
         Args:
@@ -157,15 +199,9 @@ class CustomOpenAIFunctionsAgent(BaseSingleActionAgent):
             **kwargs: User inputs.
 
         Returns:
-            Action specifying what tool to use.
+            Actions specifying what tools to use.
         """
-        agent_scratchpad = format_to_openai_functions(intermediate_steps)
-        selected_inputs = {
-            k: kwargs[k] for k in self.prompt.input_variables if k != "agent_scratchpad"
-        }
-        full_inputs = dict(**selected_inputs, agent_scratchpad=agent_scratchpad)
-        prompt = self.prompt.format_prompt(**full_inputs)
-        messages = prompt.to_messages()
+        messages = self._messages(intermediate_steps, kwargs)
         if with_functions:
             predicted_message = self.llm.predict_messages(
                 messages,
@@ -187,7 +223,7 @@ class CustomOpenAIFunctionsAgent(BaseSingleActionAgent):
         intermediate_steps: List[Tuple[AgentAction, str]],
         callbacks: Callbacks = None,
         **kwargs: Any,
-    ) -> Union[AgentAction, AgentFinish]:
+    ) -> Union[List[AgentAction], AgentFinish]:
         """Given input, decided what to do.
 
         Args:
@@ -196,15 +232,9 @@ class CustomOpenAIFunctionsAgent(BaseSingleActionAgent):
             **kwargs: User inputs.
 
         Returns:
-            Action specifying what tool to use.
+            Actions specifying what tools to use.
         """
-        agent_scratchpad = format_to_openai_functions(intermediate_steps)
-        selected_inputs = {
-            k: kwargs[k] for k in self.prompt.input_variables if k != "agent_scratchpad"
-        }
-        full_inputs = dict(**selected_inputs, agent_scratchpad=agent_scratchpad)
-        prompt = self.prompt.format_prompt(**full_inputs)
-        messages = prompt.to_messages()
+        messages = self._messages(intermediate_steps, kwargs)
         predicted_message = await self.llm.apredict_messages(
             messages, functions=self.functions, callbacks=callbacks
         )
@@ -288,7 +318,7 @@ class CustomOpenAIFunctionsAgent(BaseSingleActionAgent):
             content="You are a helpful AI assistant."
         ),
         **kwargs: Any,
-    ) -> BaseSingleActionAgent:
+    ) -> BaseMultiActionAgent:
         """Construct an agent from an LLM and tools."""
         if not isinstance(llm, ChatOpenAI):
             raise ValueError("Only supported with ChatOpenAI models.")
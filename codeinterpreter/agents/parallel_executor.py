@@ -0,0 +1,157 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, ExitStack
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from langchain.agents import AgentExecutor
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForChainRun,
+    CallbackManagerForChainRun,
+)
+from langchain.schema import AgentAction, AgentFinish
+from langchain.tools import BaseTool
+
+
+class _DeferredCall:
+    def __init__(self, tool: BaseTool, tool_input: Union[str, dict], kwargs: Dict[str, Any]) -> None:
+        self.tool = tool
+        self.tool_input = tool_input
+        self.kwargs = kwargs
+        self.observation: Any = None
+
+    def run(self) -> None:
+        self.observation = self.tool.run(self.tool_input, **self.kwargs)
+
+    async def arun(self) -> None:
+        self.observation = await self.tool.arun(self.tool_input, **self.kwargs)
+
+
+class _DeferredTool:
+    """Stands in for `tool` while the base executor walks through the actions
+    of a step: each call is recorded, to be made once all of them are known."""
+
+    def __init__(self, tool: BaseTool) -> None:
+        self.tool = tool
+        self.return_direct = tool.return_direct
+
+    def run(self, tool_input: Union[str, dict], **kwargs: Any) -> _DeferredCall:
+        return _DeferredCall(self.tool, tool_input, kwargs)
+
+    async def arun(self, tool_input: Union[str, dict], **kwargs: Any) -> _DeferredCall:
+        return _DeferredCall(self.tool, tool_input, kwargs)
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """Runs the tool calls the agent makes in one step at the same time.
+
+    A tool that is called more than once in a step and has a `forks(n)`
+    context manager (and `aforks(n)` for async runs) gets up to `n` copies of
+    itself that can run alongside it: the first call runs on the tool itself,
+    the next ones on the copies, up to `max_parallel` calls at once. Calls left
+    without a copy run after the first one on the tool itself. Either way the
+    observations are returned in the order the calls were made.
+    """
+
+    max_parallel: int = 4
+
+    def _take_next_step(
+            self,
+            name_to_tool_map: Dict[str, BaseTool],
+            color_mapping: Dict[str, str],
+            inputs: Dict[str, str],
+            intermediate_steps: List[Tuple[AgentAction, str]],
+            run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Union[AgentFinish, List[Tuple[AgentAction, str]]]:
+        output = super()._take_next_step(
+            _deferred(name_to_tool_map), color_mapping, inputs, intermediate_steps, run_manager
+        )
+        if isinstance(output, AgentFinish):
+            return output
+        calls = [observation for _, observation in output if isinstance(observation, _DeferredCall)]
+        with ExitStack() as stack:
+            lanes = self._lanes(calls, lambda tool, n: stack.enter_context(tool.forks(n)))
+            if len(lanes) == 1:
+                _run_lane(lanes[0])
+            else:
+                # the first lane stays in this thread, like a step without copies
+                with ThreadPoolExecutor(max_workers=len(lanes) - 1) as pool:
+                    futures = [pool.submit(_run_lane, lane) for lane in lanes[1:]]
+                    _run_lane(lanes[0])
+                    for future in futures:
+                        future.result()
+        return _observations(output)
+
+    async def _atake_next_step(
+            self,
+            name_to_tool_map: Dict[str, BaseTool],
+            color_mapping: Dict[str, str],
+            inputs: Dict[str, str],
+            intermediate_steps: List[Tuple[AgentAction, str]],
+            run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Union[AgentFinish, List[Tuple[AgentAction, str]]]:
+        output = await super()._atake_next_step(
+            _deferred(name_to_tool_map), color_mapping, inputs, intermediate_steps, run_manager
+        )
+        if isinstance(output, AgentFinish):
+            return output
+        calls = [observation for _, observation in output if isinstance(observation, _DeferredCall)]
+        async with AsyncExitStack() as stack:
+            copies = {}
+            for tool, n in self._forks_needed(calls):
+                copies[id(tool)] = await stack.enter_async_context(tool.aforks(n))
+            lanes = self._lanes(calls, lambda tool, n: copies[id(tool)])
+            await asyncio.gather(*(_arun_lane(lane) for lane in lanes))
+        return _observations(output)
+
+    def _forks_needed(self, calls: List[_DeferredCall]) -> List[Tuple[BaseTool, int]]:
+        needed = []
+        for tool_calls in _by_tool(calls):
+            tool = tool_calls[0].tool
+            n = min(len(tool_calls), self.max_parallel) - 1
+            if n > 0 and hasattr(tool, "forks"):
+                needed.append((tool, n))
+        return needed
+
+    def _lanes(
+            self, calls: List[_DeferredCall], fork: Callable[[BaseTool, int], List[BaseTool]]
+    ) -> List[List[_DeferredCall]]:
+        # a lane is a list of calls made one after the other; lanes run in
+        # parallel, the ones on the tools themselves first
+        forks = {id(tool): n for tool, n in self._forks_needed(calls)}
+        lanes, forked = [], []
+        for tool_calls in _by_tool(calls):
+            tool = tool_calls[0].tool
+            copies = fork(tool, forks[id(tool)]) if id(tool) in forks else []
+            for call, copy in zip(tool_calls[1:], copies):
+                call.tool = copy
+                forked.append([call])
+            lanes.append([tool_calls[0], *tool_calls[1 + len(copies):]])
+        return lanes + forked
+
+
+def _deferred(name_to_tool_map: Dict[str, BaseTool]) -> Dict[str, Any]:
+    return {name: _DeferredTool(tool) for name, tool in name_to_tool_map.items()}
+
+
+def _by_tool(calls: List[_DeferredCall]) -> List[List[_DeferredCall]]:
+    grouped: Dict[int, List[_DeferredCall]] = {}
+    for call in calls:
+        grouped.setdefault(id(call.tool), []).append(call)
+    return list(grouped.values())
+
+
+def _run_lane(lane: List[_DeferredCall]) -> None:
+    for call in lane:
+        call.run()
+
+
+async def _arun_lane(lane: List[_DeferredCall]) -> None:
+    for call in lane:
+        await call.arun()
+
+
+def _observations(output: List[Tuple[AgentAction, Any]]) -> List[Tuple[AgentAction, str]]:
+    return [
+        (action, observation.observation if isinstance(observation, _DeferredCall) else observation)
+        for action, observation in output
+    ]
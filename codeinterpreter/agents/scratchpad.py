@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain.agents.format_scratchpad.openai_functions import (
+    format_to_openai_functions,
+)
+from langchain.schema import AgentAction, AIMessage, BaseMessage, FunctionMessage
+from langchain.schema.agent import AgentActionMessageLog
+
+DEFAULT_TOKEN_BUDGET = int(os.getenv("AGENT_SCRATCHPAD_TOKENS", "6000"))
+
+Step = Tuple[AgentAction, str]
+
+# the forms a step is sent in, from longest to shortest
+FULL, COMPACT, COLLAPSED = 0, 1, 2
+
+
+class _FormattedStep:
+    def __init__(self, step: Step, full: List[BaseMessage], compact: List[BaseMessage]) -> None:
+        # held so the id() the step is cached under cannot be reused
+        self.step = step
+        self.full = full
+        self.full_tokens = estimate_tokens(full)
+        self.compact = compact
+        self.compact_tokens = estimate_tokens(compact)
+        # the shortest form the step was ever sent in
+        self.level = FULL
+
+
+class AgentScratchpad:
+    """Turns the agent's intermediate steps into prompt messages, within a budget.
+
+    Each step is formatted once and cached, so an iteration only formats the
+    step it adds. The newest steps are sent in full; once they exceed
+    `token_budget`, older steps are sent compacted (code and output cut down
+    to `summary_chars`), and steps that do not fit even then are collapsed
+    into a single note. Each step remembers the shortest form it was sent in
+    and never goes back to a longer one, even when the budget would allow it,
+    so the start of the prompt only changes when another step gets shorter.
+    """
+
+    def __init__(
+            self,
+            token_budget: int = DEFAULT_TOKEN_BUDGET,
+            keep_recent: int = 2,
+            summary_chars: int = 300,
+            cache_size: int = 1024,
+    ) -> None:
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.summary_chars = summary_chars
+        self.cache_size = cache_size
+        self._steps: "OrderedDict[int, _FormattedStep]" = OrderedDict()
+        self._prefixes: "OrderedDict[Any, List[BaseMessage]]" = OrderedDict()
+        # one agent serves every session
+        self._lock = threading.Lock()
+
+    def messages(self, intermediate_steps: Sequence[Step]) -> List[BaseMessage]:
+        formatted = [self._format(step) for step in intermediate_steps]
+
+        levels = [COLLAPSED] * len(formatted)
+        used = 0
+        for i, step in enumerate(reversed(formatted)):
+            if i < self.keep_recent or used + step.full_tokens <= self.token_budget:
+                levels[-i - 1] = FULL
+                used += step.full_tokens
+            elif used + step.compact_tokens <= self.token_budget:
+                levels[-i - 1] = COMPACT
+                used += step.compact_tokens
+            else:
+                break
+        for step, level in zip(formatted, levels):
+            step.level = max(step.level, level)
+        # the note stands for the steps before the last collapsed one too
+        collapsed = max((i + 1 for i, step in enumerate(formatted) if step.level == COLLAPSED), default=0)
+        for step in formatted[:collapsed]:
+            step.level = COLLAPSED
+
+        messages: List[BaseMessage] = []
+        if collapsed:
+            tools = sorted({step.step[0].tool for step in formatted[:collapsed]})
+            messages.append(AIMessage(content=(
+                f"[{collapsed} earlier tool calls ({', '.join(tools)}) and their "
+                "outputs were removed to save space.]"
+            )))
+        for step in formatted[collapsed:]:
+            messages.extend(step.full if step.level == FULL else step.compact)
+        return messages
+
+    def prompt_messages(
+            self, prompt, inputs: Dict[str, Any], intermediate_steps: Sequence[Step]
+    ) -> List[BaseMessage]:
+        """Formats `prompt` with `inputs` and the scratchpad.
+
+        The part before the scratchpad only depends on the inputs, so it is
+        formatted once per turn when the scratchpad is the prompt's last message.
+        """
+        scratchpad = self.messages(intermediate_steps)
+        if not _scratchpad_is_last(prompt):
+            return prompt.format_prompt(**inputs, agent_scratchpad=scratchpad).to_messages()
+
+        key = json.dumps(inputs, sort_keys=True, default=str)
+        with self._lock:
+            prefix = self._prefixes.get(key)
+            if prefix is not None:
+                self._prefixes.move_to_end(key)
+        if prefix is None:
+            prefix = prompt.format_prompt(**inputs, agent_scratchpad=[]).to_messages()
+            with self._lock:
+                self._prefixes[key] = prefix
+                while len(self._prefixes) > 64:
+                    self._prefixes.popitem(last=False)
+        return prefix + scratchpad
+
+    def _format(self, step: Step) -> _FormattedStep:
+        key = id(step)
+        with self._lock:
+            formatted = self._steps.get(key)
+            if formatted is not None and formatted.step is step:
+                self._steps.move_to_end(key)
+                return formatted
+
+        full = format_to_openai_functions([step])
+        formatted = _FormattedStep(step, full, self._compact(step, full))
+        with self._lock:
+            self._steps[key] = formatted
+            while len(self._steps) > self.cache_size:
+                self._steps.popitem(last=False)
+        return formatted
+
+    def _compact(self, step: Step, full: List[BaseMessage]) -> List[BaseMessage]:
+        action, _ = step
+        if not isinstance(action, AgentActionMessageLog):
+            return [AIMessage(content=self._shorten(action.log))]
+
+        compact: List[BaseMessage] = []
+        for message in full:
+            if isinstance(message, FunctionMessage):
+                compact.append(FunctionMessage(
+                    name=message.name, content=self._shorten(message.content)
+                ))
+                continue
+            function_call = message.additional_kwargs.get("function_call")
+            if not function_call:
+                compact.append(message)
+                continue
+            # the call has to stay so the function output still has its request
+            compact.append(AIMessage(
+                content=self._shorten(message.content),
+                additional_kwargs={"function_call": {
+                    "name": function_call["name"],
+                    "arguments": self._shorten_arguments(function_call["arguments"]),
+                }},
+            ))
+        return compact
+
+    def _shorten_arguments(self, arguments: str) -> str:
+        # keep the arguments valid JSON when they are
+        try:
+            parsed = json.loads(arguments)
+        except ValueError:
+            return self._shorten(arguments)
+        if not isinstance(parsed, dict):
+            return self._shorten(arguments)
+        return json.dumps(
+            {k: self._shorten(v) if isinstance(v, str) else v for k, v in parsed.items()},
+            ensure_ascii=False,
+        )
+
+    def _shorten(self, text: str) -> str:
+        if len(text) <= self.summary_chars:
+            return text
+        half = self.summary_chars // 2
+        omitted = len(text) - 2 * half
+        return f"{text[:half]}\n[... {omitted} characters omitted ...]\n{text[-half:]}"
+
+
+def estimate_tokens(messages: List[BaseMessage]) -> int:
+    # about 4 characters per token, plus the per-message overhead of the chat format
+    chars = 0
+    for message in messages:
+        chars += len(message.content)
+        function_call = message.additional_kwargs.get("function_call")
+        if function_call:
+            chars += len(function_call.get("name", "")) + len(function_call.get("arguments", ""))
+    return chars // 4 + 4 * len(messages)
+
+
+def _scratchpad_is_last(prompt) -> bool:
+    messages: Optional[list] = getattr(prompt, "messages", None)
+    return bool(messages) and getattr(messages[-1], "variable_name", None) == "agent_scratchpad"
@@ -1,14 +1,133 @@
+import json
 import os
 import sys
+import threading
+from typing import Any, Dict, List, Optional
+from uuid import UUID
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
 import streamlit as st
 import pandas as pd
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import AgentAction
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 from codeinterpreter.code_interpreter import CodeInterpreter, File
 from codeinterpreter.db_manager import DBManager
+from codeinterpreter.localbox import KernelPool, SessionRegistry
 
-ci = CodeInterpreter()
+
+@st.cache_resource
+def get_code_interpreter() -> CodeInterpreter:
+    # streamlit re-executes this script on every interaction, so the interpreter
+    # and its warm kernels must live in the resource cache, not at module level
+    kernel_pool = KernelPool(
+        min_size=int(os.getenv("KERNEL_POOL_MIN_SIZE", "1")),
+        max_size=int(os.getenv("KERNEL_POOL_MAX_SIZE", "4")),
+    )
+    sessions = SessionRegistry(
+        kernel_pool=kernel_pool,
+        max_sessions=kernel_pool.max_size,
+        idle_timeout=float(os.getenv("SESSION_IDLE_TIMEOUT", "1800")),
+        max_memory_percent=float(os.getenv("SESSION_MAX_MEMORY_PERCENT", "85")),
+    )
+    return CodeInterpreter(
+        sessions=sessions, streaming=os.getenv("CHAT_STREAMING", "1") == "1"
+    )
+
+
+class StreamlitResponseHandler(BaseCallbackHandler):
+    """Renders a turn into an assistant `st.chat_message` while it runs: the
+    code of each tool call as it is generated, its output, and the answer.
+
+    The calls of one step can run in parallel and end in any order; their
+    outputs are still shown in the order the calls were made, each as soon as
+    the ones before it are shown.
+    """
+
+    def __init__(self, container) -> None:
+        self.container = container
+        self.text = ""
+        self.arguments = ""
+        self.placeholder = None
+        self.ctx = get_script_run_ctx()
+        # the input of every call of the current step, in call order
+        self.calls: List[str] = []
+        self.positions: Dict[UUID, int] = {}
+        self.outputs: Dict[int, str] = {}
+        self.rendered = 0
+        self.lock = threading.Lock()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts, **kwargs: Any) -> None:
+        self.text = ""
+        self.arguments = ""
+        self.placeholder = self.container.empty()
+        with self.lock:
+            self.calls, self.positions, self.outputs, self.rendered = [], {}, {}, 0
+
+    def on_llm_new_token(self, token: str, chunk: Optional[Any] = None, **kwargs: Any) -> None:
+        function_call = chunk.additional_kwargs.get("function_call") if chunk else None
+        if function_call:
+            self.arguments += function_call.get("arguments", "")
+            self.placeholder.code(_partial_code(self.arguments), language="python")
+        elif token:
+            self.text += token
+            self.placeholder.markdown(self.text + "▌")
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> None:
+        # the executor announces every call of a step before it runs any of them
+        with self.lock:
+            self.calls.append(action.tool_input if isinstance(action.tool_input, str)
+                              else str(action.tool_input))
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID,
+                      **kwargs: Any) -> None:
+        with self.lock:
+            claimed = set(self.positions.values())
+            free = [i for i in range(len(self.calls)) if i not in claimed]
+            matching = [i for i in free if self.calls[i] == input_str]
+            if matching or free:
+                # a tool that replaces the call (InvalidTool) runs with other input
+                self.positions[run_id] = matching[0] if matching else free[-1]
+            else:
+                self.positions[run_id] = len(self.calls)
+                self.calls.append(input_str)
+
+    def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._show(run_id, output)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._show(run_id, f"{type(error).__name__}: {error}")
+
+    def _show(self, run_id: UUID, output: str) -> None:
+        with self.lock:
+            self.outputs[self.positions[run_id]] = output
+            # parallel tool calls end on worker threads, which streamlit
+            # ignores unless they carry the script's context
+            add_script_run_ctx(threading.current_thread(), self.ctx)
+            while self.rendered in self.outputs:
+                self.container.code(self.outputs.pop(self.rendered), language="text")
+                self.rendered += 1
+
+    def finish(self, content: str) -> None:
+        # the final answer replaces whatever the last LLM call streamed
+        if self.placeholder is None:
+            self.placeholder = self.container.empty()
+        self.placeholder.markdown(content)
+
+
+def _partial_code(arguments: str) -> str:
+    # the arguments are a JSON object that is still being written
+    for suffix in ("", '"}', '}'):
+        try:
+            return json.loads(arguments + suffix).get("code", "")
+        except (ValueError, AttributeError):
+            continue
+    # cut inside a key or an escape sequence: wait for the next chunk
+    return "" if arguments.lstrip().startswith("{") else arguments
+
+
+ci = get_code_interpreter()
 db = DBManager()
 
 file_path = os.path.join(os.environ.get('HOME'), "Desktop/codeinterpreter/jupyter_files")
@@ -69,13 +188,16 @@ def main():
                 if submitted:
                     with chat_container:
                         st.chat_message("user").write(text_input_value)
+                        handler = StreamlitResponseHandler(st.chat_message("assistant"))
                         with st.spinner():
                             file_url_list = []
                             if upload_file is None:
-                                response = ci.generate_response(text_input_value, None)
+                                response = ci.generate_response(text_input_value, None, session_id=chat_id,
+                                                                callbacks=[handler])
                             else:
-                                file = File(name=upload_file.name, content=upload_file.read())
-                                response = ci.generate_response(text_input_value, file)
+                                file = File.from_stream(upload_file.name, upload_file)
+                                response = ci.generate_response(text_input_value, file, session_id=chat_id,
+                                                                callbacks=[handler])
                                 file_url = "{file_path}/{file_name}".format(file_path=file_path,
                                                                             file_name=upload_file.name)
                                 file_url_list.append(file_url)
@@ -86,7 +208,7 @@ def main():
                                 save_ai_result = db.save_chat_messages(chat_id, "assistant", response.content, [])
                                 st.session_state.chat_messages.append(db.get_message_by_id(save_ai_result))
                                 with chat_container:
-                                    st.chat_message("assistant").write(response.content)
+                                    handler.finish(response.content)
                                     file_url_list = []
                                     for _file in response.files:
                                         file_url = "{file_path}/{file_name}".format(file_path=file_path,
@@ -0,0 +1,6 @@
+from .store import Artifact, ArtifactStore
+
+__all__ = [
+    "Artifact",
+    "ArtifactStore"
+]
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from codeinterpreter.schema import File
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Artifact(File):
+    """A generated file in the workspace, read from disk only when asked for."""
+
+    size: int
+    sha256: str
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        with self.open() as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+
+class ArtifactStore:
+    """Files generated while answering one request.
+
+    Only names, sizes, hashes and paths are kept; each request gets its own
+    store, so nothing outlives the response it belongs to. Tool calls running
+    in parallel may add to it at the same time.
+    """
+
+    def __init__(self, workspace: str) -> None:
+        self.workspace = workspace
+        self._artifacts: Dict[str, Artifact] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str) -> Optional[Artifact]:
+        """Records the workspace file `name`; missing and empty files are skipped.
+
+        A file written again later in the request replaces its earlier entry.
+        """
+        path = os.path.join(self.workspace, name)
+        if not os.path.isfile(path):
+            return None
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+        if not size:
+            return None
+        artifact = Artifact(name=name, path=path, size=size, sha256=digest.hexdigest())
+        with self._lock:
+            self._artifacts[name] = artifact
+        return artifact
+
+    def get(self, name: str) -> Optional[Artifact]:
+        with self._lock:
+            return self._artifacts.get(name)
+
+    @property
+    def artifacts(self) -> List[Artifact]:
+        with self._lock:
+            return list(self._artifacts.values())
+
+    def __len__(self) -> int:
+        return len(self._artifacts)
+
+    def __iter__(self) -> Iterator[Artifact]:
+        return iter(self.artifacts)
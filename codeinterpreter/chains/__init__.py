@@ -1,6 +1,5 @@
-from .chain import get_file_modifications, remove_download_link
+from .chain import remove_download_link
 
 __all__ = [
-    "get_file_modifications",
     "remove_download_link",
 ]
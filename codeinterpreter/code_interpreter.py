@@ -1,18 +1,29 @@
+import asyncio
+import os
 import re
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from uuid import uuid4
 from loguru import logger
-from typing import Type
+from typing import AsyncIterator, Iterator, List, Optional, Tuple, Type
 
-from langchain.agents import BaseSingleActionAgent, AgentExecutor
+from langchain.agents import BaseMultiActionAgent, AgentExecutor
+from langchain.callbacks.manager import Callbacks
+from langchain.pydantic_v1 import Field as ToolField
 from langchain.tools import BaseTool
 
-from codeinterpreter.chains import get_file_modifications
-from codeinterpreter.agents import CustomOpenAIFunctionsAgent
+from codeinterpreter.agents import CustomOpenAIFunctionsAgent, ParallelAgentExecutor
+from codeinterpreter.artifacts import ArtifactStore
+from codeinterpreter.observation import ObservationCompressor
 from codeinterpreter.prompts import system_message
 from codeinterpreter.schema import File, AIResponse, UserRequest
 from codeinterpreter.custom_llm import CustomChatOpenAI
 
-from codeinterpreter.localbox import (LocalBox, upload, download)
+from codeinterpreter.localbox import (
+    LocalBox, KernelPool, SessionRegistry, WorkspaceWatcher, upload
+)
+from codeinterpreter.localbox.localbox import CodeBoxOutput
+from codeinterpreter.localbox.workspace import Snapshot
 
 from pydantic import BaseModel, Field
 
@@ -31,83 +42,291 @@ class CodeInterpreterTool(BaseTool):
                 Do not start your code with a line break.
                 For example, do 'import numpy', not '\\nimport numpy'.
                 Variables are preserved between runs. 
+                Several calls made at once may run in parallel on copies of
+                the variables: they cannot see each other's variables and
+                some of their changes to variables may be lost, while files
+                written by any of them are kept. Make calls that depend on
+                each other in separate steps.
                 """
     args_schema: Type[BaseModel] = CodeInterpreterInput
+    # set by `bind()`; the unbound tool only describes itself to the agent
+    codebox: Optional[LocalBox] = None
+    watcher: Optional[WorkspaceWatcher] = None
+    artifacts: Optional[ArtifactStore] = None
+    # where `forks()` gets its kernels from
+    kernel_pool: Optional[KernelPool] = None
+    compressor: ObservationCompressor = ToolField(default_factory=ObservationCompressor)
 
-    def _run(self, code: str):
-        ci = CodeInterpreter()
-        run_response = ci.run_handler(code)
-        return run_response
+    def bind(
+            self,
+            codebox: LocalBox,
+            artifacts: ArtifactStore,
+            kernel_pool: Optional[KernelPool] = None,
+    ) -> "CodeInterpreterTool":
+        """Returns a copy of the tool that runs on `codebox` and records the
+        files its runs generate in `artifacts`."""
+        return CodeInterpreterTool(
+            codebox=codebox,
+            watcher=WorkspaceWatcher(codebox.workspace),
+            artifacts=artifacts,
+            compressor=self.compressor,
+            kernel_pool=kernel_pool,
+        )
+
+    @contextmanager
+    def forks(self, count: int) -> Iterator[List["CodeInterpreterTool"]]:
+        """Up to `count` copies of the tool, each on a pool kernel of its own
+        that starts out with this kernel's variables and works in the same
+        workspace. Fewer, or none, when the pool has fewer idle kernels.
+
+        Only kernels that are already warm are taken, so forking never waits
+        for a start. They are not free either: released kernels are stopped,
+        so every fork costs the pool a kernel that its refill thread has to
+        start again, and a new session may cold-start meanwhile.
+        """
+        forks, path = self._open_forks(count)
+        try:
+            yield [fork for fork, _ in forks]
+        finally:
+            self._close_forks(forks, path)
+
+    @asynccontextmanager
+    async def aforks(self, count: int) -> AsyncIterator[List["CodeInterpreterTool"]]:
+        loop = asyncio.get_running_loop()
+        forks, path = await loop.run_in_executor(None, self._open_forks, count)
+        try:
+            yield [fork for fork, _ in forks]
+        finally:
+            await loop.run_in_executor(None, self._close_forks, forks, path)
+
+    def _run(self, code: str) -> str:
+        if self.codebox is None:
+            raise RuntimeError("CodeInterpreterTool is not bound to a kernel")
+        logger.info("code: = {}", code)
+        before = self.watcher.snapshot()
+        output = self.codebox.run(code)
+        logger.info("output: = {}", output)
+        if package := self._missing_package(output):
+            try:
+                self.codebox.install(package)
+            except RuntimeError as e:
+                return f"{package} is missing and could not be installed: {e}"
+            return f"{package} was missing but got installed now. Please try again."
+
+        self._record_files(before, output)
+        return self._observation(output)
+
+    async def _arun(self, code: str) -> str:
+        if self.codebox is None:
+            raise RuntimeError("CodeInterpreterTool is not bound to a kernel")
+        logger.info("code: = {}", code)
+        # scanning and hashing workspace files is blocking disk I/O
+        loop = asyncio.get_running_loop()
+        before = await loop.run_in_executor(None, self.watcher.snapshot)
+        output = await self.codebox.arun(code)
+        logger.info("output: = {}", output)
+        if package := self._missing_package(output):
+            try:
+                await self.codebox.ainstall(package)
+            except RuntimeError as e:
+                return f"{package} is missing and could not be installed: {e}"
+            return f"{package} was missing but got installed now. Please try again."
+
+        await loop.run_in_executor(None, self._record_files, before, output)
+        return await loop.run_in_executor(None, self._observation, output)
+
+    def _open_forks(self, count: int) -> Tuple[List[Tuple["CodeInterpreterTool", LocalBox]], str]:
+        path = os.path.join(self.codebox.workspace, ".codebox", f"fork_{uuid4().hex[:8]}.pkl")
+        if self.kernel_pool is None or count < 1:
+            return [], path
+        boxes = []
+        while len(boxes) < count and (box := self.kernel_pool.acquire_idle()) is not None:
+            boxes.append(box)
+        if len(boxes) < count:
+            logger.info("Forking {} of {} kernels, the rest of the calls wait", len(boxes), count)
+        if not boxes:
+            return [], path
+        try:
+            self.codebox.snapshot(path)
+        except Exception as e:
+            logger.warning("Could not snapshot kernel {} to fork it: {}", self.codebox.kernel_id, e)
+            for box in boxes:
+                self.kernel_pool.release(box)
+            return [], path
+        with ThreadPoolExecutor(max_workers=len(boxes)) as pool:
+            boxes = [box for box in pool.map(lambda box: self._fork_box(box, path), boxes) if box]
+        return [(self.bind(box, self.artifacts), box) for box in boxes], path
 
-    def _arun(self, ticker: str):
-        raise NotImplementedError("python run does not support async")
+    def _fork_box(self, box: LocalBox, path: str) -> Optional[LocalBox]:
+        try:
+            box.chdir(self.codebox.workspace)
+            box.restore(path)
+        except Exception as e:
+            logger.warning("Could not fork kernel {}: {}", self.codebox.kernel_id, e)
+            self.kernel_pool.release(box)
+            return None
+        return box
+
+    def _close_forks(self, forks: List[Tuple["CodeInterpreterTool", LocalBox]], path: str) -> None:
+        for _, box in forks:
+            self.kernel_pool.release(box)
+        for file_name in (path, f"{path}.json"):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    @staticmethod
+    def _missing_package(output: CodeBoxOutput) -> Optional[str]:
+        if not isinstance(output.content, str):
+            raise TypeError("Expected output.content to be a string.")
+        if output.type == "error" and "ModuleNotFoundError" in output.content:
+            if package := re.search(
+                    r"ModuleNotFoundError: No module named '(.*)'",
+                    output.content,
+            ):
+                return package.group(1)
+        return None
+
+    def _observation(self, output: CodeBoxOutput) -> str:
+        """What the LLM gets to see of `output`: the full output summarised to
+        the compressor's budget, with the raw text kept as an artifact."""
+        if output.type == "text" and output.raw_file is not None:
+            # `content` is only the head and tail, the spill file has all of it
+            path = os.path.join(self.codebox.workspace, output.raw_file)
+            observation = self.compressor.compress_file(path)
+            return f"{observation.rstrip()}\n[full output saved to {output.raw_file}]"
+
+        observation = self.compressor.compress(output.content)
+        if observation == output.content:
+            return observation
+        file_name = f"observation_{uuid4().hex[:8]}.txt"
+        with open(os.path.join(self.codebox.workspace, file_name), "w", encoding="utf-8") as f:
+            f.write(output.content)
+        self.artifacts.add(file_name)
+        return f"{observation.rstrip()}\n[full output saved to {file_name}]"
+
+    def _record_files(self, before: Snapshot, output: CodeBoxOutput) -> None:
+        modifications = self.watcher.changes(before).files
+        # rich outputs are saved into the workspace too, this only guards
+        # against a box whose workspace is not the watched one
+        modifications += [f for f in output.files if f not in modifications]
+        for filename in modifications:
+            self.artifacts.add(filename)
 
 
 class CodeInterpreter:
-    output_files: list[File] = []
 
-    def __init__(self):
-        self.codebox = LocalBox()
+    def __init__(
+            self,
+            kernel_pool: Optional[KernelPool] = None,
+            sessions: Optional[SessionRegistry] = None,
+            streaming: bool = False,
+    ):
+        self._kernel_pool = kernel_pool if sessions is None else sessions.kernel_pool
+        self._sessions = sessions
         self.verbose = True
-        self.llm = CustomChatOpenAI()
-        self.agent_executor = self.agent_executor()
+        # with streaming, callbacks get the answer token by token through
+        # `on_llm_new_token`, function call arguments included
+        self.llm = CustomChatOpenAI(streaming=streaming)
+        self.tool = CodeInterpreterTool()
+        # the agent only needs the tool's schema, so it is built once and
+        # shared by every turn; executors are per turn, see `agent_executor()`
+        self._agent = self.agent()
 
-    def agent_executor(self) -> AgentExecutor:
-        return AgentExecutor.from_agent_and_tools(
-            agent=self.agent(),
+    def agent_executor(self, tool: CodeInterpreterTool) -> AgentExecutor:
+        return ParallelAgentExecutor.from_agent_and_tools(
+            agent=self._agent,
             max_iterations=12,
-            tools=[CodeInterpreterTool()],
+            tools=[tool],
             verbose=self.verbose,
         )
 
-    def agent(self) -> BaseSingleActionAgent:
+    def agent(self) -> BaseMultiActionAgent:
         return CustomOpenAIFunctionsAgent.from_llm_and_tools(
             llm=self.llm,
-            tools=[CodeInterpreterTool()],
+            tools=[self.tool],
             system_message=system_message
         )
 
-    def run_handler(self, code: str) -> str:
-        logger.info("code: = {}", code)
-        output = self.codebox.run(code)
-        logger.info("output: = {}", output)
-        if not isinstance(output.content, str):
-            raise TypeError("Expected output.content to be a string.")
+    @property
+    def kernel_pool(self) -> KernelPool:
+        if self._kernel_pool is None:
+            self._kernel_pool = KernelPool()
+        return self._kernel_pool
+
+    @property
+    def sessions(self) -> SessionRegistry:
+        if self._sessions is None:
+            self._sessions = SessionRegistry(kernel_pool=self.kernel_pool)
+        return self._sessions
 
-        elif output.type == "error":
-            if "ModuleNotFoundError" in output.content:
-                if package := re.search(
-                        r"ModuleNotFoundError: No module named '(.*)'",
-                        output.content,
-                ):
-                    self.codebox.install(package.group(1))
-                    return (
-                        f"{package.group(1)} was missing but"
-                        "got installed now. Please try again."
-                    )
+    def generate_response(
+            self,
+            user_msg: str,
+            file: File = None,
+            session_id: Optional[str] = None,
+            callbacks: Callbacks = None,
+    ):
+        """Runs one turn. Turns with the same `session_id` share a kernel, so
+        variables from earlier turns are still there; without one the turn
+        gets a fresh kernel that is discarded afterwards."""
+        user_request = UserRequest(content=user_msg, file=file)
+        try:
+            if session_id is None:
+                codebox = self.kernel_pool.acquire()
             else:
-                pass
-
-        if modifications := get_file_modifications(code, self.llm):
-            for filename in modifications:
-                file_out = download(filename)
-                if not file_out.content:
-                    continue
-                file_buffer = BytesIO(file_out.content)
-                file_buffer.name = filename
-                self.output_files.append(
-                    File(name=filename, content=file_buffer.read())
+                codebox = self.sessions.acquire(session_id)
+            artifacts = ArtifactStore(codebox.workspace)
+            try:
+                self._input_handler(user_request, codebox.workspace)
+                tool = self.tool.bind(codebox, artifacts, self.kernel_pool)
+                response = self.agent_executor(tool).run(
+                    input=user_request.content, callbacks=callbacks
                 )
-        return output.content
+            finally:
+                if session_id is None:
+                    self.kernel_pool.release(codebox)
+                else:
+                    self.sessions.release(session_id)
+            return self._output_handler(response, artifacts)
+        except Exception as e:
+            logger.error("Error in CodeInterpreter: e = {}",e)
+            return AIResponse(
+                content="Error in CodeInterpreter: "
+                        f"{e.__class__.__name__}  - {e}"
+            )
 
-    def generate_response(self, user_msg: str, file: File = None, ):
+    async def agenerate_response(
+            self,
+            user_msg: str,
+            file: File = None,
+            session_id: Optional[str] = None,
+            callbacks: Callbacks = None,
+    ):
+        """Async version of `generate_response`: the LLM calls and the kernel
+        executions are awaited, so one event loop can serve many turns."""
         user_request = UserRequest(content=user_msg, file=file)
+        loop = asyncio.get_running_loop()
         try:
-            self._input_handler(user_request)
-            self.codebox.start()
-            response = self.agent_executor.run(input=user_request.content)
-            self.codebox.stop()
-            return self._output_handler(response)
+            # both can block: on a free pool kernel, or on this chat's running turn
+            if session_id is None:
+                codebox = await loop.run_in_executor(None, self.kernel_pool.acquire)
+            else:
+                codebox = await loop.run_in_executor(None, self.sessions.acquire, session_id)
+            artifacts = ArtifactStore(codebox.workspace)
+            try:
+                await loop.run_in_executor(
+                    None, self._input_handler, user_request, codebox.workspace
+                )
+                tool = self.tool.bind(codebox, artifacts, self.kernel_pool)
+                response = await self.agent_executor(tool).arun(
+                    input=user_request.content, callbacks=callbacks
+                )
+            finally:
+                if session_id is None:
+                    self.kernel_pool.release(codebox)
+                else:
+                    self.sessions.release(session_id)
+            return self._output_handler(response, artifacts)
         except Exception as e:
             logger.error("Error in CodeInterpreter: e = {}",e)
             return AIResponse(
@@ -115,7 +334,7 @@ class CodeInterpreter:
                         f"{e.__class__.__name__}  - {e}"
             )
 
-    def _input_handler(self, request: UserRequest) -> None:
+    def _input_handler(self, request: UserRequest, workspace: str) -> None:
         if not request.file:
             return
         if not request.content:
@@ -124,11 +343,13 @@ class CodeInterpreter:
             )
         request.content += "\n**The user uploaded the following files: **\n"
         request.content += f"[Attachment: {request.file.name}]\n"
-        upload(request.file.name, request.file.content)
+        source = request.file.open()
+        try:
+            upload(request.file.name, source, workspace)
+        finally:
+            if source is not request.file.stream:
+                source.close()
         request.content += "**File(s) are now available in the cwd. **\n"
 
-    def _output_handler(self, final_response: str):
-
-        output_files = self.output_files
-
-        return AIResponse(content=final_response, files=output_files)
+    def _output_handler(self, final_response: str, artifacts: ArtifactStore):
+        return AIResponse(content=final_response, files=artifacts.artifacts)
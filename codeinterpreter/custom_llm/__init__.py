@@ -1,3 +1,12 @@
+from .cache import ResponseCache, get_response_cache
 from .custom_llm import CustomChatOpenAI
+from .transport import ChatTransport, ConcurrencyLimiter, get_transport
 
-__all__ = ["CustomChatOpenAI"]
+__all__ = [
+    "CustomChatOpenAI",
+    "ResponseCache",
+    "get_response_cache",
+    "ChatTransport",
+    "ConcurrencyLimiter",
+    "get_transport",
+]
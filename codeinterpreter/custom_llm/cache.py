@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+cache_path = os.getenv(
+    "CHAT_CACHE_PATH",
+    os.path.join(os.environ.get('HOME'), "Desktop/codeinterpreter/chat_cache.sqlite3"),
+)
+
+# request fields that do not change the answer
+_IGNORED_FIELDS = {"api_key", "api_base", "api_type", "api_version", "organization",
+                   "headers", "request_timeout", "stream"}
+
+
+class ResponseCache:
+    """Caches chat completion responses by a hash of the request.
+
+    A small LRU in memory sits in front of a SQLite file, so identical requests
+    are answered without the model service across restarts as well. Entries
+    expire after `ttl` seconds; once the file holds more than `max_disk_bytes`
+    of responses the least recently used ones are dropped.
+    """
+
+    def __init__(
+            self,
+            path: str = cache_path,
+            max_memory_entries: int = 256,
+            max_disk_bytes: int = 256 * 1024 * 1024,
+            ttl: float = 7 * 24 * 3600,
+    ) -> None:
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # key -> (created, serialised response); stored as text so a caller
+        # mutating its response cannot change the cached one
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._disk_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(request: Dict[str, Any]) -> str:
+        fields = {k: v for k, v in request.items() if k not in _IGNORED_FIELDS}
+        canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(entry[1])
+            self._memory.pop(key, None)
+
+            row = self._db.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._remember(key, row[1], row[0])
+            self.disk_hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        value = json.dumps(response, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            previous = self._db.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._disk_bytes += size - (previous[0] if previous else 0)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._prune(now)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_entries": entries,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM responses")
+            self._disk_bytes = 0
+
+    def _remember(self, key: str, created: float, value: str) -> None:
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _prune(self, now: float) -> None:
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self._disk_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        # leave some room so the next few puts do not prune again
+        target = self.max_disk_bytes * 0.9
+        removed = 0
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if self._disk_bytes <= target:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            self._disk_bytes -= size
+            removed += 1
+        if removed:
+            logger.info("Dropped {} cached chat responses to stay under the size limit", removed)
+
+
+_default_cache: Optional[ResponseCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """The shared cache, or None unless CHAT_CACHE=1."""
+    global _default_cache
+    if os.getenv("CHAT_CACHE") != "1":
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(
+                max_memory_entries=int(os.getenv("CHAT_CACHE_MEMORY_ENTRIES", "256")),
+                max_disk_bytes=int(os.getenv("CHAT_CACHE_MAX_MB", "256")) * 1024 * 1024,
+                ttl=float(os.getenv("CHAT_CACHE_TTL", str(7 * 24 * 3600))),
+            )
+        return _default_cache
@@ -1,12 +1,22 @@
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
 from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.openai import _convert_delta_to_message_chunk, acompletion_with_retry
 from openai.api_resources.abstract.engine_api_resource import EngineAPIResource
-from typing import Any, Mapping, Dict
-from langchain.schema import ChatResult
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Type, Union
+from langchain.schema import BaseMessage, ChatResult
+from langchain.schema.messages import AIMessageChunk, BaseMessageChunk
+from langchain.schema.output import ChatGenerationChunk
 from langchain.pydantic_v1 import root_validator
 import os
-import requests
 from loguru import logger
 import json
+import asyncio
+
+from .cache import get_response_cache
+from .transport import get_transport
 
 
 class CustomChatOpenAI(ChatOpenAI):
@@ -41,18 +51,285 @@ class CustomChatOpenAI(ChatOpenAI):
             ):
                 chat_result.llm_output["model_name"] = model
 
+        # ChatOpenAI only knows `function_call`; a response calling several
+        # tools at once lists them in `tool_calls`
+        for generation, res in zip(chat_result.generations, response["choices"]):
+            if tool_calls := res["message"].get("tool_calls"):
+                generation.message.additional_kwargs["tool_calls"] = tool_calls
+
         return chat_result
 
+    def _stream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        params = {**params, **kwargs, "stream": True}
+
+        default_chunk_class = AIMessageChunk
+        for chunk in self.completion_with_retry(
+                messages=message_dicts, run_manager=run_manager, **params
+        ):
+            if len(chunk["choices"]) == 0:
+                continue
+            choice = chunk["choices"][0]
+            chunk = _message_chunk(choice["delta"], default_chunk_class)
+            finish_reason = choice.get("finish_reason")
+            generation_info = (
+                dict(finish_reason=finish_reason) if finish_reason is not None else None
+            )
+            default_chunk_class = chunk.__class__
+            yield ChatGenerationChunk(message=chunk, generation_info=generation_info)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.content, chunk=chunk)
+
+    async def _astream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        params = {**params, **kwargs, "stream": True}
+
+        default_chunk_class = AIMessageChunk
+        async for chunk in await acompletion_with_retry(
+                self, messages=message_dicts, run_manager=run_manager, **params
+        ):
+            if len(chunk["choices"]) == 0:
+                continue
+            choice = chunk["choices"][0]
+            chunk = _message_chunk(choice["delta"], default_chunk_class)
+            finish_reason = choice.get("finish_reason")
+            generation_info = (
+                dict(finish_reason=finish_reason) if finish_reason is not None else None
+            )
+            default_chunk_class = chunk.__class__
+            yield ChatGenerationChunk(message=chunk, generation_info=generation_info)
+            if run_manager:
+                await run_manager.on_llm_new_token(token=chunk.content, chunk=chunk)
+
+
+def _message_chunk(delta: Mapping[str, Any], default_class: Type[BaseMessageChunk]) -> BaseMessageChunk:
+    chunk = _convert_delta_to_message_chunk(delta, default_class)
+    # the stream carries `tool_calls` complete, in a chunk of their own
+    if delta.get("tool_calls") and isinstance(chunk, AIMessageChunk):
+        chunk.additional_kwargs["tool_calls"] = delta["tool_calls"]
+    return chunk
+
 
 class CustomChatCompletion(EngineAPIResource):
     chat_model_url = os.getenv("CHAT_MODEL_SERVICE_URL", "")
+    # how the function specs are sent. "tools" (`tools`/`tool_choice`) is what
+    # lets a model call several functions in one response: the OpenAI API
+    # (gpt-3.5-turbo-1106, gpt-4-turbo and later), Azure OpenAI from API version
+    # 2023-12-01-preview, and vLLM or llama.cpp servers started with tool
+    # calling enabled. "functions" (`functions`/`function_call`) is the fallback
+    # for services that only know the legacy fields; they make one call per turn.
+    tool_format = os.getenv("CHAT_TOOL_FORMAT", "tools")
 
     @classmethod
     def create(cls, *args, **kwargs):
-        payload = {
-            'messages': kwargs.get("messages"),
-            'functions': kwargs.get("functions", None),
+        cache, key = cls._cache_key(kwargs)
+        if key is not None and (cached := cache.get(key)) is not None:
+            return iter([_as_chunk(cached)]) if kwargs.get("stream") else cached
+        payload = cls._payload(kwargs)
+        if kwargs.get("stream"):
+            return cls._stream(payload, cache, key)
+        with get_transport().post(cls.chat_model_url, payload) as response:
+            text = response.text
+        logger.info("response = {}", text)
+        result = json.loads(text)
+        if key is not None and _cacheable(result):
+            cache.put(key, result)
+        return result
+
+    @classmethod
+    async def acreate(cls, *args, **kwargs):
+        cache, key = cls._cache_key(kwargs)
+        loop = asyncio.get_running_loop()
+        if key is not None and (cached := await loop.run_in_executor(None, cache.get, key)) is not None:
+            return _aiter([_as_chunk(cached)]) if kwargs.get("stream") else cached
+        payload = cls._payload(kwargs)
+        if kwargs.get("stream"):
+            return cls._astream(payload, cache, key)
+        async with get_transport().apost(cls.chat_model_url, payload) as response:
+            text = await response.text()
+        logger.info("response = {}", text)
+        result = json.loads(text)
+        if key is not None and _cacheable(result):
+            await loop.run_in_executor(None, cache.put, key, result)
+        return result
+
+    @classmethod
+    def _stream(cls, payload: Dict[str, Any], cache, key) -> Iterator[Dict[str, Any]]:
+        stream = _StreamedResponse()
+        with get_transport().post(cls.chat_model_url, payload, stream=True) as response:
+            if not _is_stream(response.headers.get("Content-Type", "")):
+                # the service answered in one piece
+                yield stream.add(_as_chunk(response.json()))
+            else:
+                for line in response.iter_lines(decode_unicode=True):
+                    if (chunk := stream.parse(line)) is not None:
+                        yield chunk
+            if (chunk := stream.tool_calls_chunk()) is not None:
+                yield chunk
+        logger.info("response = {}", stream.result())
+        if key is not None and _cacheable(stream.result()):
+            cache.put(key, stream.result())
+
+    @classmethod
+    async def _astream(cls, payload: Dict[str, Any], cache, key) -> AsyncIterator[Dict[str, Any]]:
+        stream = _StreamedResponse()
+        async with get_transport().apost(cls.chat_model_url, payload) as response:
+            if not _is_stream(response.headers.get("Content-Type", "")):
+                yield stream.add(_as_chunk(json.loads(await response.text())))
+            else:
+                async for line in response.content:
+                    if (chunk := stream.parse(line.decode("utf-8"))) is not None:
+                        yield chunk
+            if (chunk := stream.tool_calls_chunk()) is not None:
+                yield chunk
+        logger.info("response = {}", stream.result())
+        if key is not None and _cacheable(stream.result()):
+            await asyncio.get_running_loop().run_in_executor(
+                None, cache.put, key, stream.result()
+            )
+
+    @staticmethod
+    def _cache_key(kwargs: Dict[str, Any]):
+        # streamed requests share entries with the others, `stream` is not part of the key
+        cache = get_response_cache()
+        if cache is None:
+            return cache, None
+        return cache, cache.key(kwargs)
+
+    @classmethod
+    def _payload(cls, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {'messages': kwargs.get("messages")}
+        functions = kwargs.get("functions", None)
+        function_call = kwargs.get("function_call", None)
+        if functions and cls.tool_format == "tools":
+            payload['tools'] = [{"type": "function", "function": spec} for spec in functions]
+            if function_call is not None:
+                payload['tool_choice'] = _tool_choice(function_call)
+        else:
+            payload['functions'] = functions
+            if function_call is not None:
+                payload['function_call'] = function_call
+        if kwargs.get("stream"):
+            payload['stream'] = True
+        return payload
+
+
+def _tool_choice(function_call: Union[str, Mapping[str, Any]]) -> Union[str, Dict[str, Any]]:
+    # "auto" and "none" mean the same in both; a named function gets wrapped
+    if isinstance(function_call, str):
+        return function_call
+    return {"type": "function", "function": {"name": function_call["name"]}}
+
+
+def _cacheable(response: Mapping[str, Any]) -> bool:
+    return bool(response.get("choices")) and "error" not in response
+
+
+def _is_stream(content_type: str) -> bool:
+    return content_type.startswith(("text/event-stream", "application/x-ndjson"))
+
+
+class _StreamedResponse:
+    """Parses a streamed completion, server-sent events or one JSON chunk per
+    line, and assembles the full response from its deltas for the cache."""
+
+    def __init__(self) -> None:
+        self.model: Optional[str] = None
+        self.choices: Dict[int, Dict[str, Any]] = {}
+        self.done = False
+
+    def parse(self, line: str) -> Optional[Dict[str, Any]]:
+        line = line.strip()
+        if self.done or not line or line.startswith((":", "event:", "id:", "retry:")):
+            return None
+        if line.startswith("data:"):
+            line = line[len("data:"):].strip()
+        if line == "[DONE]":
+            self.done = True
+            return None
+        return self.add(_as_chunk(json.loads(line)))
+
+    def add(self, chunk: Dict[str, Any]) -> Dict[str, Any]:
+        if "error" in chunk:
+            raise ValueError(f"Chat model service error: {chunk['error']}")
+        self.model = chunk.get("model", self.model)
+        for choice in chunk.get("choices", []):
+            message = self.choices.setdefault(choice.get("index", 0), {
+                "message": {"role": "assistant", "content": ""}, "finish_reason": None,
+            })
+            delta = choice.get("delta", {})
+            message["message"]["content"] += delta.get("content") or ""
+            if function_call := delta.get("function_call"):
+                merged = message["message"].setdefault(
+                    "function_call", {"name": "", "arguments": ""}
+                )
+                merged["name"] += function_call.get("name") or ""
+                merged["arguments"] += function_call.get("arguments") or ""
+            if tool_calls := delta.pop("tool_calls", None):
+                # arrive in pieces like `function_call`, but the pieces are list
+                # items, which langchain cannot merge: they are passed on once
+                # complete, by `tool_calls_chunk()`
+                self._add_tool_calls(message["message"], tool_calls)
+            if choice.get("finish_reason"):
+                message["finish_reason"] = choice["finish_reason"]
+        return chunk
+
+    def tool_calls_chunk(self) -> Optional[Dict[str, Any]]:
+        choices = [
+            {"index": i, "delta": {"tool_calls": choice["message"]["tool_calls"]},
+             "finish_reason": choice["finish_reason"]}
+            for i, choice in sorted(self.choices.items())
+            if choice["message"].get("tool_calls")
+        ]
+        return {"model": self.model, "choices": choices} if choices else None
+
+    @staticmethod
+    def _add_tool_calls(message: Dict[str, Any], tool_calls: List[Dict[str, Any]]) -> None:
+        merged = message.setdefault("tool_calls", [])
+        for position, call in enumerate(tool_calls):
+            index = call.get("index", position)
+            while len(merged) <= index:
+                merged.append({"id": "", "type": "function",
+                               "function": {"name": "", "arguments": ""}})
+            target = merged[index]
+            target["id"] += call.get("id") or ""
+            function = call.get("function") or {}
+            target["function"]["name"] += function.get("name") or ""
+            target["function"]["arguments"] += function.get("arguments") or ""
+
+    def result(self) -> Dict[str, Any]:
+        choices = [{"index": i, **choice} for i, choice in sorted(self.choices.items())]
+        return {"model": self.model, "choices": choices}
+
+
+def _as_chunk(response: Mapping[str, Any]) -> Dict[str, Any]:
+    # a whole response (cached, or from a service that does not stream) as a
+    # single chunk, which is what ChatOpenAI expects once it asked for a stream
+    if "error" in response or not any("message" in c for c in response.get("choices", [])):
+        return dict(response)
+    choices = [
+        {
+            "index": choice.get("index", i),
+            "delta": dict(choice.get("message", {})),
+            "finish_reason": choice.get("finish_reason"),
         }
-        response = requests.post(cls.chat_model_url, json=payload)
-        logger.info("response = {}", response.text)
-        return json.loads(response.text)
+        for i, choice in enumerate(response["choices"])
+    ]
+    return {**response, "choices": choices}
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
@@ -0,0 +1,270 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, Optional, Union
+
+import aiohttp
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+# worth retrying: the service is overloaded or failed, not the request
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ConcurrencyLimiter:
+    """Lets at most `max_concurrency` requests run at once, across threads and
+    event loops alike. The others wait in line, first come first served, for
+    at most `timeout` seconds."""
+
+    def __init__(self, max_concurrency: int, timeout: Optional[float] = None) -> None:
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.active = 0
+        # threading.Event for threads, (loop, future) for coroutines
+        self._waiters: Deque[Union[threading.Event, tuple]] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self) -> AsyncIterator[None]:
+        await self.aacquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return
+            granted = threading.Event()
+            self._waiters.append(granted)
+        if granted.wait(self.timeout):
+            return
+        with self._lock:
+            if granted in self._waiters:
+                self._waiters.remove(granted)
+                raise TimeoutError(f"No request slot became free within {self.timeout}s")
+        # handed a slot just as the wait timed out
+        return
+
+    async def aacquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return
+            granted = loop.create_future()
+            waiter = (loop, granted)
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    waiter = None
+            if waiter is not None:
+                # the slot was handed over meanwhile; pass it on once it arrives
+                granted.add_done_callback(lambda _: self.release())
+            if isinstance(e, asyncio.TimeoutError):
+                raise TimeoutError(f"No request slot became free within {self.timeout}s")
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            # the slot goes straight to the next waiter, `active` stays the same
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+            return
+        loop, granted = waiter
+        try:
+            loop.call_soon_threadsafe(_grant, granted)
+        except RuntimeError:
+            # its loop is gone
+            self.release()
+
+
+def _grant(granted: asyncio.Future) -> None:
+    if not granted.done():
+        granted.set_result(None)
+
+
+class ChatTransport:
+    """The HTTP client every chat completion request goes through.
+
+    Connections are pooled and kept alive, requests time out instead of
+    hanging on a stalled service, 429 and 5xx answers and connection errors
+    are retried with jittered exponential backoff (honouring Retry-After), and
+    a `ConcurrencyLimiter` queues requests beyond `max_concurrency`.
+    """
+
+    def __init__(
+            self,
+            max_concurrency: int = 8,
+            max_connections: int = 16,
+            connect_timeout: float = 10.0,
+            read_timeout: float = 300.0,
+            max_retries: int = 3,
+            backoff: float = 0.5,
+            max_backoff: float = 30.0,
+            queue_timeout: Optional[float] = None,
+    ) -> None:
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_connections = max_connections
+        self.limiter = ConcurrencyLimiter(max_concurrency, queue_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # aiohttp sessions belong to the event loop they were created on
+        self._async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def post(self, url: str, payload: Dict[str, Any], stream: bool = False) -> Iterator[requests.Response]:
+        """Posts `payload` as JSON; the request holds its slot until the block
+        exits, so a streamed body counts against the limit while it is read."""
+        with self.limiter.slot():
+            response = self._send(url, payload, stream)
+            try:
+                yield response
+            finally:
+                response.close()
+
+    @asynccontextmanager
+    async def apost(self, url: str, payload: Dict[str, Any]) -> AsyncIterator[aiohttp.ClientResponse]:
+        async with self.limiter.aslot():
+            response = await self._asend(url, payload)
+            try:
+                yield response
+            finally:
+                response.release()
+
+    def close(self) -> None:
+        self.session.close()
+
+    async def aclose(self) -> None:
+        session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _send(self, url: str, payload: Dict[str, Any], stream: bool) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                response = self.session.post(
+                    url, json=payload, stream=stream,
+                    timeout=(self.connect_timeout, self.read_timeout),
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last:
+                    raise
+                delay = self._delay(attempt)
+                logger.warning("Chat model request failed ({}), retrying in {:.1f}s", e, delay)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                if last:
+                    response.raise_for_status()
+                delay = self._delay(attempt, response.headers.get("Retry-After"))
+                logger.warning(
+                    "Chat model service answered {}, retrying in {:.1f}s", response.status_code, delay
+                )
+                response.close()
+            time.sleep(delay)
+
+    async def _asend(self, url: str, payload: Dict[str, Any]) -> aiohttp.ClientResponse:
+        session = self._async_session()
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                response = await session.post(url, json=payload)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last:
+                    raise
+                delay = self._delay(attempt)
+                logger.warning("Chat model request failed ({}), retrying in {:.1f}s", e, delay)
+            else:
+                if response.status not in RETRY_STATUSES:
+                    return response
+                if last:
+                    response.raise_for_status()
+                delay = self._delay(attempt, response.headers.get("Retry-After"))
+                logger.warning(
+                    "Chat model service answered {}, retrying in {:.1f}s", response.status, delay
+                )
+                response.release()
+            await asyncio.sleep(delay)
+
+    def _async_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.get(loop)
+            if session is None or session.closed:
+                session = self._async_sessions[loop] = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.max_connections),
+                    timeout=aiohttp.ClientTimeout(
+                        sock_connect=self.connect_timeout, sock_read=self.read_timeout
+                    ),
+                )
+            return session
+
+    def _delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        # full jitter, so clients that failed together do not retry together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+_default_transport: Optional[ChatTransport] = None
+_default_transport_lock = threading.Lock()
+
+
+def get_transport() -> ChatTransport:
+    """The transport shared by every chat completion request of the process."""
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            queue_timeout = os.getenv("CHAT_QUEUE_TIMEOUT")
+            _default_transport = ChatTransport(
+                max_concurrency=int(os.getenv("CHAT_MAX_CONCURRENCY", "8")),
+                max_connections=int(os.getenv("CHAT_MAX_CONNECTIONS", "16")),
+                connect_timeout=float(os.getenv("CHAT_CONNECT_TIMEOUT", "10")),
+                read_timeout=float(os.getenv("CHAT_READ_TIMEOUT", "300")),
+                max_retries=int(os.getenv("CHAT_MAX_RETRIES", "3")),
+                queue_timeout=float(queue_timeout) if queue_timeout else None,
+            )
+        return _default_transport
@@ -1,8 +1,23 @@
-from .localbox import LocalBox, upload, download, list_files
+from .localbox import LocalBox, upload, download, open_download, iter_download, list_files
+from .gateway import GatewayManager
+from .kernel_pool import KernelPool
+from .packages import PackageCache
+from .sessions import SessionRegistry
+from .snapshot import SnapshotReport
+from .workspace import FileChanges, WorkspaceWatcher
 
 __all__ = [
     "LocalBox",
+    "GatewayManager",
+    "KernelPool",
+    "PackageCache",
+    "SessionRegistry",
+    "WorkspaceWatcher",
+    "FileChanges",
+    "SnapshotReport",
     "upload",
     "download",
+    "open_download",
+    "iter_download",
     "list_files"
 ]
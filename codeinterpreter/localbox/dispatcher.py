@@ -0,0 +1,151 @@
+import asyncio
+import json
+import queue
+import threading
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+from websockets.client import WebSocketClientProtocol
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.client import ClientConnection
+
+
+class MessageDispatcher:
+    """Reads a kernel channels websocket in a background thread and routes every
+    message, parsed once, to the queue of the request named in its parent header.
+
+    Several executions can be in flight on one connection. When the connection
+    drops, every pending queue receives `None`.
+    """
+
+    def __init__(self, ws: ClientConnection) -> None:
+        self.ws = ws
+        self.closing = False
+        # closed to be replaced by a new connection to the same kernel
+        self.replaced = False
+        self.close_reason: Optional[str] = None
+        self.closed = False
+        self._queues: Dict[str, queue.Queue] = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(
+            target=self._read_loop, name="kernel-ws-reader", daemon=True
+        )
+        self._reader.start()
+
+    def submit(self, msg_id: str, request: str) -> Tuple[queue.Queue, bool]:
+        """Sends `request`; returns the queue its replies go to, and whether
+        the request went out before the connection closed."""
+        messages: queue.Queue = queue.Queue()
+        with self._lock:
+            if self.closed:
+                messages.put(None)
+                return messages, False
+            self._queues[msg_id] = messages
+        # if the send fails, the reader notices the same close and wakes the queue up
+        return messages, self.send(request)
+
+    def send(self, request: str) -> bool:
+        """Sends a message whose replies nobody waits for; False if the
+        connection is closed."""
+        with self._send_lock:
+            try:
+                self.ws.send(request)
+            except ConnectionClosed:
+                return False
+        return True
+
+    def discard(self, msg_id: str) -> None:
+        with self._lock:
+            self._queues.pop(msg_id, None)
+
+    def expect_close(self, reason: Optional[str] = None) -> None:
+        # `reason` is reported to the executions that were still waiting
+        self.closing = True
+        self.close_reason = reason
+
+    def close(self, reason: Optional[str] = None, replaced: bool = False) -> None:
+        # with `replaced`, the executions still waiting retry on the new connection
+        self.replaced = self.replaced or replaced
+        self.expect_close(reason or self.close_reason)
+        self.ws.close()
+        self._reader.join(timeout=5)
+
+    def _read_loop(self) -> None:
+        try:
+            for raw in self.ws:
+                received_msg = json.loads(raw)
+                parent_id = received_msg.get("parent_header", {}).get("msg_id")
+                with self._lock:
+                    messages = self._queues.get(parent_id)
+                if messages is not None:
+                    messages.put(received_msg)
+        except ConnectionClosed as e:
+            if not self.closing:
+                logger.warning("Kernel websocket closed: {}", e)
+        finally:
+            with self._lock:
+                self.closed = True
+                pending = list(self._queues.values())
+            for messages in pending:
+                messages.put(None)
+
+
+class AsyncMessageDispatcher:
+    """asyncio counterpart of `MessageDispatcher` driven by a reader task."""
+
+    def __init__(self, ws: WebSocketClientProtocol) -> None:
+        self.ws = ws
+        self.closing = False
+        self.replaced = False
+        self.close_reason: Optional[str] = None
+        self.closed = False
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self.loop = asyncio.get_running_loop()
+        self._reader: Optional[asyncio.Task] = self.loop.create_task(self._read_loop())
+
+    async def submit(self, msg_id: str, request: str) -> Tuple[asyncio.Queue, bool]:
+        messages: asyncio.Queue = asyncio.Queue()
+        if self.closed:
+            messages.put_nowait(None)
+            return messages, False
+        self._queues[msg_id] = messages
+        return messages, await self.send(request)
+
+    async def send(self, request: str) -> bool:
+        try:
+            await self.ws.send(request)
+        except ConnectionClosed:
+            return False
+        return True
+
+    def discard(self, msg_id: str) -> None:
+        self._queues.pop(msg_id, None)
+
+    def expect_close(self, reason: Optional[str] = None) -> None:
+        self.closing = True
+        self.close_reason = reason
+
+    async def close(self, reason: Optional[str] = None, replaced: bool = False) -> None:
+        self.replaced = self.replaced or replaced
+        self.expect_close(reason or self.close_reason)
+        await self.ws.close()
+        if self._reader is not None:
+            await self._reader
+            self._reader = None
+
+    async def _read_loop(self) -> None:
+        try:
+            async for raw in self.ws:
+                received_msg = json.loads(raw)
+                parent_id = received_msg.get("parent_header", {}).get("msg_id")
+                messages = self._queues.get(parent_id)
+                if messages is not None:
+                    messages.put_nowait(received_msg)
+        except ConnectionClosed as e:
+            if not self.closing:
+                logger.warning("Kernel websocket closed: {}", e)
+        finally:
+            self.closed = True
+            for messages in list(self._queues.values()):
+                messages.put_nowait(None)
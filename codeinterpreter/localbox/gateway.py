@@ -0,0 +1,226 @@
+import atexit
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from importlib.metadata import PackageNotFoundError, distribution
+from pathlib import Path
+from typing import Deque, List, Optional
+
+from loguru import logger
+
+from .supervisor import OWNER_ENV, owner_marker, reap_orphaned_processes
+
+_LOG_LEVELS = {"D": "DEBUG", "I": "INFO", "W": "WARNING", "E": "ERROR", "C": "CRITICAL"}
+
+
+def _check_installed() -> None:
+    try:
+        distribution("jupyter-kernel-gateway")
+    except PackageNotFoundError:
+        print(
+            "Make sure 'jupyter-kernel-gateway' is installed "
+            "when using without a CODEBOX_API_KEY.\n"
+            "You can install it with 'pip install jupyter-kernel-gateway'."
+        )
+        raise
+
+
+def _find_free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class Gateway:
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            process: subprocess.Popen,
+            log_size: int = 200,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.process = process
+        self.kernels = 0
+        self.log: Deque[str] = deque(maxlen=log_size)
+        self.ready = threading.Event()
+        self._drainer = threading.Thread(
+            target=self._drain_output, name=f"kernel-gateway-{port}-log", daemon=True
+        )
+        self._drainer.start()
+
+    def _drain_output(self) -> None:
+        # the gateway writes to a pipe; if nobody reads it the pipe buffer fills
+        # up and the gateway blocks on its next log line
+        for raw in iter(self.process.stdout.readline, b""):
+            line = raw.decode("utf-8", errors="replace").rstrip()
+            if not line:
+                continue
+            self.log.append(line)
+            level = _LOG_LEVELS.get(line[1:2], "INFO") if line.startswith("[") else "INFO"
+            logger.log(level, "[gateway:{}] {}", self.port, line)
+            if "is available at" in line:
+                self.ready.set()
+        self.process.stdout.close()
+
+    def wait_ready(self, timeout: float = 60.0) -> None:
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while not self.ready.is_set():
+            if not self.is_alive():
+                self._drainer.join(timeout=1)
+                raise RuntimeError(
+                    f"Kernel gateway exited with code {self.process.returncode}:\n"
+                    + "\n".join(self.log)
+                )
+            try:
+                with socket.create_connection((self.host, self.port), timeout=0.1):
+                    self.ready.set()
+                    break
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                self.terminate()
+                raise TimeoutError(f"Kernel gateway did not start within {timeout}s")
+            self.ready.wait(delay)
+            delay = min(delay * 2, 0.1)
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/api"
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://{self.host}:{self.port}/api"
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def terminate(self) -> None:
+        if self.is_alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+class GatewayManager:
+    """Runs a small fixed number of kernel gateways shared by every LocalBox.
+
+    Boxes only create and delete kernels on a gateway through its
+    `/api/kernels` endpoints, so starting a session is a single POST.
+    """
+
+    def __init__(self, cwd: str, size: int = 1, host: str = "localhost") -> None:
+        if size < 1:
+            raise ValueError("A gateway manager needs at least one gateway")
+        self.cwd = cwd
+        self.size = size
+        self.host = host
+        self._gateways: List[Gateway] = []
+        self._closed = False
+        self._lock = threading.Lock()
+        _managers.add(self)
+        if reaped := reap_orphaned_processes():
+            logger.info("Reaped {} orphaned kernel processes", reaped)
+
+    @property
+    def gateways(self) -> List[Gateway]:
+        with self._lock:
+            return list(self._gateways)
+
+    def acquire(self) -> Gateway:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Gateway manager is shut down")
+            for gateway in [g for g in self._gateways if not g.is_alive()]:
+                logger.warning("Kernel gateway on port {} died, dropping it", gateway.port)
+                self._gateways.remove(gateway)
+            if len(self._gateways) < self.size:
+                gateway = self._start_gateway()
+                self._gateways.append(gateway)
+            else:
+                gateway = min(self._gateways, key=lambda g: g.kernels)
+            gateway.kernels += 1
+            return gateway
+
+    def release(self, gateway: Gateway) -> None:
+        with self._lock:
+            gateway.kernels = max(gateway.kernels - 1, 0)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._closed = True
+            gateways, self._gateways = self._gateways, []
+        for gateway in gateways:
+            gateway.terminate()
+
+    def _start_gateway(self) -> Gateway:
+        _check_installed()
+        port = _find_free_port(self.host)
+        logger.info("Starting kernel gateway on port {}...", port)
+        try:
+            python = Path(sys.executable).absolute()
+            process = subprocess.Popen(
+                [
+                    python,
+                    "-m",
+                    "jupyter",
+                    "kernelgateway",
+                    "--KernelGatewayApp.ip='0.0.0.0'",
+                    f"--KernelGatewayApp.port={port}",
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=self.cwd,
+                env={**os.environ, OWNER_ENV: owner_marker()},
+            )
+        except FileNotFoundError:
+            raise ModuleNotFoundError(
+                "Jupyter Kernel Gateway not found, please install it with:\n"
+                "`pip install jupyter_kernel_gateway`\n"
+                "to use the LocalBox."
+            )
+        gateway = Gateway(self.host, port, process)
+        gateway.wait_ready()
+        logger.info("Kernel gateway on port {} is ready", port)
+        return gateway
+
+
+_managers: "weakref.WeakSet[GatewayManager]" = weakref.WeakSet()
+
+
+def _shutdown_managers() -> None:
+    for manager in list(_managers):
+        manager.shutdown()
+
+
+# registered on import, so it runs after the handlers of the modules that
+# import this one (atexit is last in, first out): a KernelPool's refill
+# thread is stopped before the gateways it starts kernels on
+atexit.register(_shutdown_managers)
+
+_default_manager: Optional[GatewayManager] = None
+_default_manager_lock = threading.Lock()
+
+
+def get_gateway_manager(cwd: str) -> GatewayManager:
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            _default_manager = GatewayManager(
+                cwd=cwd, size=int(os.getenv("KERNEL_GATEWAY_COUNT", "1"))
+            )
+        return _default_manager
@@ -0,0 +1,176 @@
+import atexit
+import threading
+import time
+import weakref
+from typing import List, Optional
+
+from loguru import logger
+
+from .localbox import LocalBox
+
+
+class KernelPool:
+    """Keeps started, connected LocalBoxes warm so a turn never pays the cold start.
+
+    Boxes handed out by `acquire()` are owned by the caller until `release()`.
+    Released boxes are stopped (their state belongs to the previous user) and
+    the background refill thread starts fresh ones to keep `min_size` idle.
+    """
+
+    def __init__(
+            self,
+            min_size: int = 1,
+            max_size: int = 4,
+            refill_interval: float = 5.0,
+    ) -> None:
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Expected 0 <= min_size <= max_size and max_size >= 1")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.refill_interval = refill_interval
+        self._idle: List[LocalBox] = []
+        self._retired: List[LocalBox] = []
+        self._in_use = 0
+        self._starting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._wakeup.set()
+        self._refill_thread = threading.Thread(
+            target=self._refill_loop, name="kernel-pool-refill", daemon=True
+        )
+        self._refill_thread.start()
+        _pools.add(self)
+
+    @property
+    def size(self) -> int:
+        return len(self._idle) + self._in_use + self._starting
+
+    def acquire(self, timeout: Optional[float] = None) -> LocalBox:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Kernel pool is closed")
+                if self._idle:
+                    box = self._idle.pop()
+                    self._in_use += 1
+                    self._wakeup.set()
+                    return box
+                if self.size < self.max_size:
+                    # nothing warm yet: start one in the caller's thread rather
+                    # than waiting for the refill thread to get around to it
+                    self._starting += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Timed out waiting for a free kernel")
+                self._cond.wait(remaining)
+
+        try:
+            box = self._start_box()
+        except BaseException:
+            with self._cond:
+                self._starting -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._starting -= 1
+            self._in_use += 1
+        self._wakeup.set()
+        return box
+
+    def acquire_idle(self) -> Optional[LocalBox]:
+        """An already warm box, or None; never starts one or waits for one."""
+        with self._cond:
+            if self._closed or not self._idle:
+                return None
+            box = self._idle.pop()
+            self._in_use += 1
+        self._wakeup.set()
+        return box
+
+    def release(self, box: LocalBox) -> None:
+        with self._cond:
+            self._in_use -= 1
+            self._retired.append(box)
+            self._cond.notify_all()
+        self._wakeup.set()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            boxes = self._idle + self._retired
+            self._idle = []
+            self._retired = []
+            self._cond.notify_all()
+        self._wakeup.set()
+        for box in boxes:
+            self._stop_box(box)
+        if threading.current_thread() is not self._refill_thread:
+            # it may be starting a box, which it stops itself once it sees the pool closed
+            self._refill_thread.join(timeout=30)
+
+    def _start_box(self) -> LocalBox:
+        box = LocalBox()
+        box.start()
+        return box
+
+    @staticmethod
+    def _stop_box(box: LocalBox) -> None:
+        try:
+            box.stop()
+        except Exception as e:
+            logger.warning("Failed to stop kernel {}: {}", box.kernel_id, e)
+
+    def _refill_loop(self) -> None:
+        while True:
+            self._wakeup.wait(self.refill_interval)
+            self._wakeup.clear()
+            with self._cond:
+                if self._closed:
+                    return
+                retired, self._retired = self._retired, []
+            for box in retired:
+                self._stop_box(box)
+
+            while True:
+                with self._cond:
+                    if self._closed:
+                        return
+                    if (
+                            len(self._idle) + self._starting >= self.min_size
+                            or self.size >= self.max_size
+                    ):
+                        break
+                    self._starting += 1
+                try:
+                    box = self._start_box()
+                except Exception as e:
+                    logger.error("Failed to warm up kernel: {}", e)
+                    with self._cond:
+                        self._starting -= 1
+                        self._cond.notify_all()
+                    break
+                with self._cond:
+                    self._starting -= 1
+                    closed = self._closed
+                    if not closed:
+                        self._idle.append(box)
+                        self._cond.notify_all()
+                if closed:
+                    self._stop_box(box)
+                    return
+                logger.info("Kernel {} warmed up", box.kernel_id)
+
+
+_pools: "weakref.WeakSet[KernelPool]" = weakref.WeakSet()
+
+
+def _close_pools() -> None:
+    for pool in list(_pools):
+        pool.close()
+
+
+# runs before the gateways are shut down, see gateway.py
+atexit.register(_close_pools)
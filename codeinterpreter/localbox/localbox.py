@@ -1,64 +1,158 @@
 import asyncio
+import binascii
+import io
 import json
 import os
-import signal
-import subprocess
-import sys
+import queue
+import threading
 import time
-from asyncio.subprocess import Process
-from importlib.metadata import PackageNotFoundError, distribution
-from pathlib import Path
-from typing import List, Optional, Union
+from typing import (
+    Any, AsyncIterator, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+)
 from uuid import uuid4
 from abc import ABC
 from uuid import UUID
+import aiohttp
 import requests
 from websockets.client import WebSocketClientProtocol
-from websockets.exceptions import ConnectionClosedError
+from websockets.client import connect as ws_connect
 from websockets.sync.client import ClientConnection
 from websockets.sync.client import connect as ws_connect_sync
 
 from pydantic import BaseModel
 from loguru import logger
 
-jupyter_file_path = os.path.join(os.environ.get('HOME'), "Desktop/codeinterpreter/jupyter_files")
+from .dispatcher import AsyncMessageDispatcher, MessageDispatcher
+from .gateway import Gateway, GatewayManager, get_gateway_manager
+from .output_buffer import OutputBuffer
+from .packages import PackageCache, get_package_cache
+from .snapshot import (
+    MAX_OBJECT_BYTES, MAX_TOTAL_BYTES, SnapshotReport, restore_code, snapshot_code
+)
+from .supervisor import get_supervisor
 
+jupyter_file_path = os.path.join(os.environ.get('HOME'), "Desktop/codeinterpreter/jupyter_files")
 
-def _check_installed() -> None:
-    try:
-        distribution("jupyter-kernel-gateway")
-    except PackageNotFoundError:
-        print(
-            "Make sure 'jupyter-kernel-gateway' is installed "
-            "when using without a CODEBOX_API_KEY.\n"
-            "You can install it with 'pip install jupyter-kernel-gateway'."
-        )
-        raise
+DEFAULT_EXECUTION_TIMEOUT = float(os.getenv("CODEBOX_EXECUTION_TIMEOUT", "300"))
 
 
 class CodeBoxOutput(BaseModel):
     type: str
     content: str
+    # names of the files in the workspace that rich outputs were saved to
+    files: List[str] = []
+    # name of the file holding the full text output, when `content` is cut short
+    raw_file: Optional[str] = None
+
+
+class CodeBoxEvent(BaseModel):
+    # one of "stream", "execute_result", "display_data", "error", "timeout" or "idle"
+    type: str
+    content: str = ""
+    data: Dict[str, Any] = {}
 
 
 class FileOutput(BaseModel):
     name: str
     content: Optional[bytes] = None
+    path: Optional[str] = None
+
+
+CHUNK_SIZE = 1024 * 1024
 
+UploadContent = Union[bytes, BinaryIO, Iterable[bytes]]
 
-def upload(file_name: str, content: bytes):
-    os.makedirs(jupyter_file_path, exist_ok=True)
-    with open(os.path.join(jupyter_file_path, file_name), "wb") as f:
-        f.write(content)
+
+def upload(
+        file_name: str,
+        content: UploadContent,
+        workspace: Optional[str] = None,
+        chunk_size: int = CHUNK_SIZE,
+):
+    """Writes `content` into the workspace one chunk at a time.
+
+    `content` can be bytes, a binary file object or an iterable of byte chunks.
+    The file only appears under its final name once it is complete.
+    """
+    workspace = workspace or jupyter_file_path
+    os.makedirs(workspace, exist_ok=True)
+    path = os.path.join(workspace, file_name)
+    tmp_path = f"{path}.{uuid4().hex[:8]}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            if isinstance(content, (bytes, bytearray, memoryview)):
+                f.write(content)
+            elif hasattr(content, "read"):
+                _copy_stream(content, f, chunk_size)
+            else:
+                for chunk in content:
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
     return f"{file_name} uploaded successfully"
 
 
-def download(file_name: str) -> FileOutput:
-    with open(os.path.join(jupyter_file_path, file_name), "rb") as f:
+def _copy_stream(source: BinaryIO, target: BinaryIO, chunk_size: int) -> None:
+    if _sendfile(source, target, chunk_size):
+        return
+    if hasattr(source, "getbuffer"):
+        # in-memory uploads (e.g. streamlit's UploadedFile) are written from
+        # their buffer directly instead of being copied by read()
+        buffer = source.getbuffer()
+        try:
+            for i in range(0, len(buffer), chunk_size):
+                target.write(buffer[i:i + chunk_size])
+        finally:
+            buffer.release()
+        return
+    while chunk := source.read(chunk_size):
+        target.write(chunk)
+
+
+def _sendfile(source: BinaryIO, target: BinaryIO, chunk_size: int) -> bool:
+    # a real file on disk is copied by the OS without passing through user space
+    if not hasattr(os, "sendfile"):
+        return False
+    try:
+        source_fd = source.fileno()
+        start = offset = source.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    target.flush()
+    try:
+        while sent := os.sendfile(target.fileno(), source_fd, offset, chunk_size):
+            offset += sent
+    except OSError:
+        if offset != start:
+            raise
+        return False
+    return True
+
+
+def download(file_name: str, workspace: Optional[str] = None) -> FileOutput:
+    path = os.path.join(workspace or jupyter_file_path, file_name)
+    with open(path, "rb") as f:
         content = f.read()
 
-    return FileOutput(name=file_name, content=content)
+    return FileOutput(name=file_name, content=content, path=path)
+
+
+def open_download(file_name: str, workspace: Optional[str] = None) -> BinaryIO:
+    return open(os.path.join(workspace or jupyter_file_path, file_name), "rb")
+
+
+def iter_download(
+        file_name: str,
+        workspace: Optional[str] = None,
+        chunk_size: int = CHUNK_SIZE,
+) -> Iterator[bytes]:
+    with open_download(file_name, workspace) as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
 
 
 def list_files() -> List[FileOutput]:
@@ -69,82 +163,118 @@ def list_files() -> List[FileOutput]:
 
 
 class LocalBox(ABC):
-    _jupyter_pids: List[int] = []
 
-    def __init__(self, session_id: Optional[UUID] = None) -> None:
+    def __init__(
+            self,
+            session_id: Optional[UUID] = None,
+            gateway_manager: Optional[GatewayManager] = None,
+            output_head_size: int = 250,
+            output_tail_size: int = 500,
+            execution_timeout: Optional[float] = DEFAULT_EXECUTION_TIMEOUT,
+            interrupt_grace: float = 5.0,
+            package_cache: Optional[PackageCache] = None,
+            workspace: Optional[str] = None,
+    ) -> None:
         self.session_id = session_id
+        self.gateway_manager = gateway_manager
+        self.gateway: Optional[Gateway] = None
         self.port: int = 8888
-        self.kernel_id: Optional[dict] = None
+        self.kernel_id: Optional[str] = None
+        self.workspace: str = workspace or jupyter_file_path
+        self.output_head_size = output_head_size
+        self.output_tail_size = output_tail_size
+        self.execution_timeout = execution_timeout
+        self.interrupt_grace = interrupt_grace
+        self._package_cache = package_cache
         self.ws: Union[WebSocketClientProtocol, ClientConnection, None] = None
-        self.jupyter: Union[Process, subprocess.Popen, None] = None
+        self._dispatcher: Union[MessageDispatcher, AsyncMessageDispatcher, None] = None
+        # second, asyncio connection to a kernel started with start(), opened
+        # by the first arun() so sync and async callers can share the kernel
+        self._async_bridge: Optional[AsyncMessageDispatcher] = None
+        self._reconnect_lock = threading.Lock()
+        self._areconnect_lock: Optional[asyncio.Lock] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
 
     def start(self):
         self.session_id = uuid4()
         os.makedirs(jupyter_file_path, exist_ok=True)
-        self._check_port()
+        if self.gateway_manager is None:
+            self.gateway_manager = get_gateway_manager(jupyter_file_path)
+        if self.gateway is None:
+            self.gateway = self.gateway_manager.acquire()
+        self.port = self.gateway.port
         logger.info("Starting kernel...")
-        out = subprocess.PIPE
-        _check_installed()
-        try:
-            python = Path(sys.executable).absolute()
-            self.jupyter = subprocess.Popen(
-                [
-                    python,
-                    "-m",
-                    "jupyter",
-                    "kernelgateway",
-                    "--KernelGatewayApp.ip='0.0.0.0'",
-                    f"--KernelGatewayApp.port={self.port}",
-                ],
-                stdout=out,
-                stderr=out,
-                cwd=jupyter_file_path,
-            )
-            self._jupyter_pids.append(self.jupyter.pid)
-        except FileNotFoundError:
-            raise ModuleNotFoundError(
-                "Jupyter Kernel Gateway not found, please install it with:\n"
-                "`pip install jupyter_kernel_gateway`\n"
-                "to use the LocalBox."
-            )
-        while True:
-            try:
-                response = requests.get(self.kernel_url, timeout=270)
-                if response.status_code == 200:
-                    break
-            except requests.exceptions.ConnectionError:
-                pass
-            logger.info("Waiting for kernel to start...")
-            time.sleep(1)
         self._connect()
+        self._enter_workspace()
+        get_supervisor().register(self)
         return "started"
 
-    def stop(self):
-        try:
-            if self.jupyter is not None:
-                self.jupyter.terminate()
-                self.jupyter.wait()
-                self.jupyter = None
-                time.sleep(2)
-            else:
-                for pid in self._jupyter_pids:
-                    os.kill(pid, signal.SIGTERM)
-        except ProcessLookupError:
-            pass
+    async def astart(self):
+        self.session_id = uuid4()
+        os.makedirs(jupyter_file_path, exist_ok=True)
+        if self.gateway_manager is None:
+            self.gateway_manager = get_gateway_manager(jupyter_file_path)
+        if self.gateway is None:
+            # only the very first box pays for spawning the shared gateway
+            loop = asyncio.get_running_loop()
+            self.gateway = await loop.run_in_executor(None, self.gateway_manager.acquire)
+        self.port = self.gateway.port
+        logger.info("Starting kernel...")
+        self.loop = asyncio.get_running_loop()
+        await self._aconnect()
+        await self._aenter_workspace()
+        get_supervisor().register(self)
+        return "started"
 
+    def stop(self):
         if self.ws is not None:
+            if isinstance(self.ws, WebSocketClientProtocol):
+                raise RuntimeError("Kernel was started with astart(), use astop() instead")
+            self._close_async_bridge()
+            self._dispatcher.close()
+            self._dispatcher = None
+            self.ws = None
+
+        if self.kernel_id is not None:
+            get_supervisor().unregister(self)
             try:
-                if isinstance(self.ws, ClientConnection):
-                    self.ws.close()
-                else:
-                    loop = asyncio.new_event_loop()
-                    loop.run_until_complete(self.ws.close())
-            except ConnectionClosedError:
-                pass
+                requests.delete(f"{self.kernel_url}/kernels/{self.kernel_id}", timeout=30)
+            except requests.exceptions.RequestException as e:
+                logger.warning("Could not delete kernel {}: {}", self.kernel_id, e)
+            self.kernel_id = None
+
+        self._release_gateway()
+        return "stopped"
+
+    async def astop(self):
+        if self.ws is not None:
+            if isinstance(self.ws, ClientConnection):
+                raise RuntimeError("Kernel was started with start(), use stop() instead")
+            await self._dispatcher.close()
+            self._dispatcher = None
             self.ws = None
 
+        if self.kernel_id is not None:
+            get_supervisor().unregister(self)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.delete(
+                            f"{self.kernel_url}/kernels/{self.kernel_id}",
+                            timeout=aiohttp.ClientTimeout(total=30),
+                    ):
+                        pass
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Could not delete kernel {}: {}", self.kernel_id, e)
+            self.kernel_id = None
+
+        self._release_gateway()
         return "stopped"
 
+    def _release_gateway(self) -> None:
+        if self.gateway is not None:
+            self.gateway_manager.release(self.gateway)
+            self.gateway = None
+
     def _connect(self) -> None:
         response = requests.post(
             f"{self.kernel_url}/kernels",
@@ -155,129 +285,530 @@ class LocalBox(ABC):
         if self.kernel_id is None:
             raise Exception("Could not start kernel")
 
-        self.ws = ws_connect_sync(f"{self.ws_url}/kernels/{self.kernel_id}/channels")
+        self._connect_ws()
 
-    def _check_port(self) -> None:
-        try:
-            response = requests.get(f"http://localhost:{self.port}", timeout=270)
-        except requests.exceptions.ConnectionError:
-            pass
-        else:
-            if response.status_code == 200:
-                self.port += 1
-                self._check_port()
+    def _connect_ws(self) -> None:
+        self.ws = ws_connect_sync(
+            f"{self.ws_url}/kernels/{self.kernel_id}/channels", max_size=None
+        )
+        self._dispatcher = MessageDispatcher(self.ws)
+
+    async def _aconnect(self) -> None:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                    f"{self.kernel_url}/kernels",
+                    headers={"Content-Type": "application/json"},
+                    timeout=aiohttp.ClientTimeout(total=270),
+            ) as response:
+                self.kernel_id = (await response.json())["id"]
+        if self.kernel_id is None:
+            raise Exception("Could not start kernel")
+
+        await self._aconnect_ws()
+
+    async def _aconnect_ws(self) -> None:
+        self.ws = await ws_connect(
+            f"{self.ws_url}/kernels/{self.kernel_id}/channels", max_size=None
+        )
+        self._dispatcher = AsyncMessageDispatcher(self.ws)
+
+    def interrupt(self) -> None:
+        requests.post(f"{self.kernel_url}/kernels/{self.kernel_id}/interrupt", timeout=30)
+
+    async def ainterrupt(self) -> None:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                    f"{self.kernel_url}/kernels/{self.kernel_id}/interrupt",
+                    timeout=aiohttp.ClientTimeout(total=30),
+            ):
+                pass
+
+    def restart(self, reason: Optional[str] = None) -> None:
+        logger.warning("Restarting kernel {}", self.kernel_id)
+        with self._reconnect_lock:
+            # the gateway may drop the old connection itself while restarting;
+            # executions still waiting on it get `reason` instead of a retry
+            self._dispatcher.expect_close(reason or _RESTARTED)
+            self._close_async_bridge(reason or _RESTARTED)
+            requests.post(f"{self.kernel_url}/kernels/{self.kernel_id}/restart", timeout=270)
+            self._dispatcher.close()
+            self._connect_ws()
+        # a restarted kernel is back in the gateway's directory
+        self._enter_workspace()
+
+    async def arestart(self, reason: Optional[str] = None) -> None:
+        if isinstance(self.ws, ClientConnection):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.restart, reason)
+            return
+        logger.warning("Restarting kernel {}", self.kernel_id)
+        self._dispatcher.expect_close(reason or _RESTARTED)
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                    f"{self.kernel_url}/kernels/{self.kernel_id}/restart",
+                    timeout=aiohttp.ClientTimeout(total=270),
+            ):
+                pass
+        await self._dispatcher.close()
+        await self._aconnect_ws()
+        await self._aenter_workspace()
 
     def run(
             self,
             code: Optional[str] = None,
             file_path: Optional[os.PathLike] = None,
             retry=3,
+            timeout: Optional[float] = None,
     ) -> CodeBoxOutput:
-        if not code and not file_path:
-            raise ValueError("Code or file_path must be specified!")
+        collector = self._collector()
+        try:
+            for event in self.run_stream(code, file_path, retry, timeout):
+                collector.add(event)
+        finally:
+            collector.close()
+        return collector.output()
 
-        if code and file_path:
-            raise ValueError("Can only specify code or the file to read_from!")
+    async def arun(
+            self,
+            code: Optional[str] = None,
+            file_path: Optional[os.PathLike] = None,
+            retry=3,
+            timeout: Optional[float] = None,
+    ) -> CodeBoxOutput:
+        collector = self._collector()
+        try:
+            async for event in self.arun_stream(code, file_path, retry, timeout):
+                collector.add(event)
+        finally:
+            collector.close()
+        return collector.output()
 
-        if file_path:
-            with open(file_path, "r", encoding="utf-8") as f:
-                code = f.read()
+    def run_stream(
+            self,
+            code: Optional[str] = None,
+            file_path: Optional[os.PathLike] = None,
+            retry=3,
+            timeout: Optional[float] = None,
+    ) -> Iterator[CodeBoxEvent]:
+        code = self._read_code(code, file_path)
 
         # run code in jupyter kernel
         if retry <= 0:
             raise RuntimeError("Could not connect to kernel")
         if not self.ws:
-            self._connect()
+            self.start()
             if not self.ws:
                 raise RuntimeError("Jupyter not running. Make sure to start it first.")
+        if isinstance(self.ws, WebSocketClientProtocol):
+            raise RuntimeError("Mixing asyncio and sync code is not supported")
 
         # send code to kernel
-        self.ws.send(
-            json.dumps(
-                {
-                    "header": {
-                        "msg_id": (msg_id := uuid4().hex),
-                        "msg_type": "execute_request",
-                    },
-                    "parent_header": {},
-                    "metadata": {},
-                    "content": {
-                        "code": code,
-                        "silent": False,
-                        "store_history": True,
-                        "user_expressions": {},
-                        "allow_stdin": False,
-                        "stop_on_error": True,
-                    },
-                    "channel": "shell",
-                    "buffers": [],
-                }
-            )
-        )
-        result = ""
+        timeout = self.execution_timeout if timeout is None else timeout
+        # until the kernel gets to the request, this bounds the wait behind
+        # other executions; after that, the run itself
+        deadline = _deadline(timeout)
+        started = cancelled = False
+        dispatcher = self._dispatcher
+        msg_id, request = self._execute_request(code)
+        messages, sent = dispatcher.submit(msg_id, request)
+        try:
+            while True:
+                try:
+                    received_msg = messages.get(timeout=_remaining(deadline))
+                except queue.Empty:
+                    if started:
+                        yield self._handle_timeout(messages, timeout)
+                        return
+                    if cancelled:
+                        yield _timeout_event(timeout, restarted=False, started=False)
+                        return
+                    # the code running now belongs to another execution, so
+                    # take this one out of the kernel's queue instead
+                    dispatcher.send(self._abort_request(msg_id))
+                    cancelled = True
+                    deadline = _deadline(self.interrupt_grace)
+                    continue
+                if received_msg is None:
+                    if dispatcher.close_reason:
+                        yield CodeBoxEvent(type="error", content=dispatcher.close_reason)
+                        return
+                    if dispatcher.closing and not dispatcher.replaced:
+                        raise RuntimeError("Kernel connection was closed")
+                    self._reconnect(dispatcher)
+                    if sent:
+                        # the kernel may have got the code; running it again
+                        # would repeat its side effects and the events already sent
+                        yield CodeBoxEvent(type="error", content=_CONNECTION_LOST)
+                        return
+                    yield from self.run_stream(code, retry=retry - 1, timeout=timeout)
+                    return
+                if cancelled and _is_aborted(received_msg):
+                    yield _timeout_event(timeout, restarted=False, started=False)
+                    return
+                if not started and _is_started(received_msg, cancelled):
+                    started = True
+                    deadline = _deadline(timeout)
+
+                event = self._parse_event(received_msg)
+                if event is None:
+                    continue
+                if event.type == "error" and dispatcher.close_reason:
+                    # the KeyboardInterrupt caused by a restart, say why it happened
+                    event = CodeBoxEvent(type="error", content=dispatcher.close_reason)
+                yield event
+                if event.type == "idle":
+                    return
+        finally:
+            dispatcher.discard(msg_id)
+
+    async def arun_stream(
+            self,
+            code: Optional[str] = None,
+            file_path: Optional[os.PathLike] = None,
+            retry=3,
+            timeout: Optional[float] = None,
+    ) -> AsyncIterator[CodeBoxEvent]:
+        code = self._read_code(code, file_path)
+
+        if retry <= 0:
+            raise RuntimeError("Could not connect to kernel")
+        if not self.ws:
+            await self.astart()
+            if not self.ws:
+                raise RuntimeError("Jupyter not running. Make sure to start it first.")
+
+        timeout = self.execution_timeout if timeout is None else timeout
+        deadline = _deadline(timeout)
+        started = cancelled = False
+        if isinstance(self.ws, ClientConnection):
+            dispatcher = await self._open_async_bridge()
+        else:
+            dispatcher = self._dispatcher
+        msg_id, request = self._execute_request(code)
+        messages, sent = await dispatcher.submit(msg_id, request)
+        try:
+            while True:
+                try:
+                    received_msg = await asyncio.wait_for(
+                        messages.get(), _remaining(deadline)
+                    )
+                except asyncio.TimeoutError:
+                    if started:
+                        yield await self._ahandle_timeout(messages, timeout)
+                        return
+                    if cancelled:
+                        yield _timeout_event(timeout, restarted=False, started=False)
+                        return
+                    await dispatcher.send(self._abort_request(msg_id))
+                    cancelled = True
+                    deadline = _deadline(self.interrupt_grace)
+                    continue
+                if received_msg is None:
+                    if dispatcher.close_reason:
+                        yield CodeBoxEvent(type="error", content=dispatcher.close_reason)
+                        return
+                    if dispatcher.closing and not dispatcher.replaced:
+                        raise RuntimeError("Kernel connection was closed")
+                    await self._areconnect(dispatcher)
+                    if sent:
+                        yield CodeBoxEvent(type="error", content=_CONNECTION_LOST)
+                        return
+                    async for event in self.arun_stream(
+                            code, retry=retry - 1, timeout=timeout
+                    ):
+                        yield event
+                    return
+                if cancelled and _is_aborted(received_msg):
+                    yield _timeout_event(timeout, restarted=False, started=False)
+                    return
+                if not started and _is_started(received_msg, cancelled):
+                    started = True
+                    deadline = _deadline(timeout)
+
+                event = self._parse_event(received_msg)
+                if event is None:
+                    continue
+                if event.type == "error" and dispatcher.close_reason:
+                    # the KeyboardInterrupt caused by a restart, say why it happened
+                    event = CodeBoxEvent(type="error", content=dispatcher.close_reason)
+                yield event
+                if event.type == "idle":
+                    return
+        finally:
+            dispatcher.discard(msg_id)
+
+    def _handle_timeout(self, messages: queue.Queue, timeout: float) -> CodeBoxEvent:
+        logger.warning("Execution on kernel {} timed out after {}s", self.kernel_id, timeout)
+        self.interrupt()
+        deadline = time.monotonic() + self.interrupt_grace
+        while True:
+            try:
+                received_msg = messages.get(timeout=_remaining(deadline))
+            except queue.Empty:
+                break
+            if received_msg is None:
+                break
+            if _is_idle(received_msg):
+                return _timeout_event(timeout, restarted=False)
+        self.restart()
+        return _timeout_event(timeout, restarted=True)
+
+    async def _ahandle_timeout(self, messages: asyncio.Queue, timeout: float) -> CodeBoxEvent:
+        logger.warning("Execution on kernel {} timed out after {}s", self.kernel_id, timeout)
+        await self.ainterrupt()
+        deadline = time.monotonic() + self.interrupt_grace
         while True:
             try:
-                if isinstance(self.ws, WebSocketClientProtocol):
-                    raise RuntimeError("Mixing asyncio and sync code is not supported")
-                received_msg = json.loads(self.ws.recv())
-            except ConnectionClosedError:
+                received_msg = await asyncio.wait_for(messages.get(), _remaining(deadline))
+            except asyncio.TimeoutError:
+                break
+            if received_msg is None:
+                break
+            if _is_idle(received_msg):
+                return _timeout_event(timeout, restarted=False)
+        await self.arestart()
+        return _timeout_event(timeout, restarted=True)
+
+    def _reconnect(self, dispatcher: MessageDispatcher) -> None:
+        # several in-flight executions see the same dropped connection; only
+        # the first one to get here replaces it, the others retry on the new one
+        with self._reconnect_lock:
+            if self._dispatcher is not dispatcher:
+                return
+            dispatcher.close(replaced=True)
+            try:
+                # the same kernel, so a session keeps its variables
+                self._connect_ws()
+            except Exception as e:
+                logger.warning("Kernel {} is gone, starting a new one: {}", self.kernel_id, e)
+                self.stop()
                 self.start()
-                return self.run(code, file_path, retry - 1)
 
-            if (
-                    received_msg["header"]["msg_type"] == "stream"
-                    and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                msg = received_msg["content"]["text"].strip()
-                if "Requirement already satisfied:" in msg:
-                    continue
-                result += msg + "\n"
+    async def _areconnect(self, dispatcher: AsyncMessageDispatcher) -> None:
+        if dispatcher is self._async_bridge:
+            # the sync connection owns the kernel; just open a new bridge next time
+            self._async_bridge = None
+            return
+        if self._areconnect_lock is None:
+            self._areconnect_lock = asyncio.Lock()
+        async with self._areconnect_lock:
+            if self._dispatcher is not dispatcher:
+                return
+            await dispatcher.close(replaced=True)
+            try:
+                await self._aconnect_ws()
+            except Exception as e:
+                logger.warning("Kernel {} is gone, starting a new one: {}", self.kernel_id, e)
+                await self.astop()
+                await self.astart()
+
+    async def _open_async_bridge(self) -> AsyncMessageDispatcher:
+        bridge = self._async_bridge
+        if bridge is not None and not bridge.closed and bridge.loop is asyncio.get_running_loop():
+            return bridge
+        # e.g. every asyncio.run() gets a new loop, and connections cannot move
+        self._close_async_bridge()
+        # a short close_timeout: a loop that ends with the bridge still open
+        # would otherwise wait 10s on a close handshake nobody needs
+        ws = await ws_connect(
+            f"{self.ws_url}/kernels/{self.kernel_id}/channels", max_size=None, close_timeout=0.1
+        )
+        self._async_bridge = AsyncMessageDispatcher(ws)
+        return self._async_bridge
+
+    def _close_async_bridge(self, reason: Optional[str] = None) -> None:
+        # may be called from any thread, the bridge belongs to its event loop
+        bridge, self._async_bridge = self._async_bridge, None
+        if bridge is None:
+            return
+        bridge.expect_close(reason)
+        if bridge.loop.is_closed():
+            # the loop is gone and its connections with it
+            return
+        asyncio.run_coroutine_threadsafe(bridge.close(reason), bridge.loop)
+
+    def _collector(self) -> "_OutputCollector":
+        return _OutputCollector(self.workspace, self.output_head_size, self.output_tail_size)
+
+    @staticmethod
+    def _read_code(code: Optional[str], file_path: Optional[os.PathLike]) -> str:
+        if not code and not file_path:
+            raise ValueError("Code or file_path must be specified!")
 
-            elif (
-                    received_msg["header"]["msg_type"] == "execute_result"
-                    and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                result += received_msg["content"]["data"]["text/plain"].strip() + "\n"
+        if code and file_path:
+            raise ValueError("Can only specify code or the file to read_from!")
 
-            elif received_msg["header"]["msg_type"] == "display_data":
-                if "image/png" in received_msg["content"]["data"]:
-                    return CodeBoxOutput(
-                        type="image/png",
-                        content="",
-                    )
-                if "text/plain" in received_msg["content"]["data"]:
-                    return CodeBoxOutput(
-                        type="text",
-                        content=received_msg["content"]["data"]["text/plain"],
-                    )
-                return CodeBoxOutput(
-                    type="error",
-                    content="Could not parse output",
-                )
-            elif (
-                    received_msg["header"]["msg_type"] == "status"
-                    and received_msg["parent_header"]["msg_id"] == msg_id
-                    and received_msg["content"]["execution_state"] == "idle"
-            ):
-                if len(result) > 500:
-                    result = "[...]\n" + result[-500:]
-                return CodeBoxOutput(
-                    type="text", content=result or "code run successfully (no output)"
-                )
-
-            elif (
-                    received_msg["header"]["msg_type"] == "error"
-                    and received_msg["parent_header"]["msg_id"] == msg_id
-            ):
-                error = (
-                    f"{received_msg['content']['ename']}: "
-                    f"{received_msg['content']['evalue']}"
-                )
-                return CodeBoxOutput(type="error", content=error)
+        if file_path:
+            with open(file_path, "r", encoding="utf-8") as f:
+                code = f.read()
+        return code
+
+    @staticmethod
+    def _execute_request(code: str) -> Tuple[str, str]:
+        msg_id = uuid4().hex
+        request = json.dumps(
+            {
+                "header": {
+                    "msg_id": msg_id,
+                    "msg_type": "execute_request",
+                },
+                "parent_header": {},
+                "metadata": {},
+                "content": {
+                    "code": code,
+                    "silent": False,
+                    "store_history": True,
+                    "user_expressions": {},
+                    "allow_stdin": False,
+                    "stop_on_error": True,
+                },
+                "channel": "shell",
+                "buffers": [],
+            }
+        )
+        return msg_id, request
+
+    @staticmethod
+    def _abort_request(msg_id: str) -> str:
+        # ipykernel still honours this ipyparallel control message: the
+        # execute_request is answered as aborted instead of being run
+        return json.dumps(
+            {
+                "header": {
+                    "msg_id": uuid4().hex,
+                    "msg_type": "abort_request",
+                },
+                "parent_header": {},
+                "metadata": {},
+                "content": {"msg_ids": [msg_id]},
+                "channel": "control",
+                "buffers": [],
+            }
+        )
+
+    @staticmethod
+    def _parse_event(received_msg: dict) -> Optional[CodeBoxEvent]:
+        msg_type = received_msg["header"]["msg_type"]
+        content = received_msg["content"]
+
+        if msg_type == "stream":
+            return CodeBoxEvent(
+                type="stream", content=content["text"], data={"name": content["name"]}
+            )
+        if msg_type in ("execute_result", "display_data"):
+            return CodeBoxEvent(
+                type=msg_type,
+                content=content["data"].get("text/plain", ""),
+                data=content["data"],
+            )
+        if msg_type == "error":
+            return CodeBoxEvent(
+                type="error",
+                content=f"{content['ename']}: {content['evalue']}",
+                data=content,
+            )
+        if _is_idle(received_msg):
+            return CodeBoxEvent(type="idle")
+        return None
 
     def install(self, package_name: str):
-        self.run(f"!pip install -q {package_name}")
-        return f"{package_name} installed successfully"
+        distribution = self.package_cache.install(package_name)
+        # the kernel's import system caches directory listings from before the install
+        self.run("import importlib; importlib.invalidate_caches()")
+        return f"{distribution} installed successfully"
+
+    async def ainstall(self, package_name: str):
+        loop = asyncio.get_running_loop()
+        distribution = await loop.run_in_executor(
+            None, self.package_cache.install, package_name
+        )
+        await self.arun("import importlib; importlib.invalidate_caches()")
+        return f"{distribution} installed successfully"
+
+    def chdir(self, workspace: str) -> None:
+        """Moves the kernel, and everything this box reads and writes, to `workspace`."""
+        os.makedirs(workspace, exist_ok=True)
+        self._check_chdir(self.run(f"import os; os.chdir({workspace!r})"))
+        self.workspace = workspace
+
+    async def achdir(self, workspace: str) -> None:
+        os.makedirs(workspace, exist_ok=True)
+        self._check_chdir(await self.arun(f"import os; os.chdir({workspace!r})"))
+        self.workspace = workspace
+
+    def _enter_workspace(self) -> None:
+        # kernels start in the gateway's directory, the default workspace
+        if self.workspace != jupyter_file_path:
+            self.chdir(self.workspace)
+
+    async def _aenter_workspace(self) -> None:
+        if self.workspace != jupyter_file_path:
+            await self.achdir(self.workspace)
+
+    @staticmethod
+    def _check_chdir(output: CodeBoxOutput) -> None:
+        if output.type != "text":
+            raise RuntimeError(f"Could not change the kernel's directory: {output.content}")
+
+    def snapshot(
+            self,
+            path: Optional[str] = None,
+            max_object_bytes: int = MAX_OBJECT_BYTES,
+            max_total_bytes: int = MAX_TOTAL_BYTES,
+    ) -> SnapshotReport:
+        """Saves the kernel's user namespace to `path` so `restore()` can load
+        it into a fresh kernel. Values that cannot be pickled or are over the
+        limits are left out and listed in the report."""
+        path = path or self.snapshot_path
+        output = self.run(snapshot_code(path, max_object_bytes, max_total_bytes))
+        return self._snapshot_report(path, output, "snapshot")
+
+    async def asnapshot(
+            self,
+            path: Optional[str] = None,
+            max_object_bytes: int = MAX_OBJECT_BYTES,
+            max_total_bytes: int = MAX_TOTAL_BYTES,
+    ) -> SnapshotReport:
+        path = path or self.snapshot_path
+        output = await self.arun(snapshot_code(path, max_object_bytes, max_total_bytes))
+        return self._snapshot_report(path, output, "snapshot")
+
+    def restore(self, path: Optional[str] = None) -> SnapshotReport:
+        path = path or self.snapshot_path
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No snapshot at {path}")
+        return self._snapshot_report(path, self.run(restore_code(path)), "restore")
+
+    async def arestore(self, path: Optional[str] = None) -> SnapshotReport:
+        path = path or self.snapshot_path
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No snapshot at {path}")
+        return self._snapshot_report(path, await self.arun(restore_code(path)), "restore")
+
+    @staticmethod
+    def _snapshot_report(path: str, output: CodeBoxOutput, action: str) -> SnapshotReport:
+        if output.type != "text":
+            raise RuntimeError(f"Could not {action} the kernel: {output.content}")
+        # the report goes through a file, printed it could be cut by the output buffer
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            report = SnapshotReport.model_validate_json(f.read())
+        logger.info(
+            "Kernel {}: {} objects ({} bytes) and {} modules, skipped {}",
+            action, len(report.objects), report.bytes, len(report.modules),
+            sorted(report.skipped) or "none",
+        )
+        return report
+
+    @property
+    def snapshot_path(self) -> str:
+        # hidden, so the workspace watcher never reports it as a generated file
+        return os.path.join(self.workspace, ".codebox", "namespace.pkl")
+
+    @property
+    def package_cache(self) -> PackageCache:
+        if self._package_cache is None:
+            self._package_cache = get_package_cache()
+        return self._package_cache
 
     @property
     def kernel_url(self) -> str:
@@ -288,3 +819,166 @@ class LocalBox(ABC):
         return f"ws://localhost:{self.port}/api"
 
 
+_RESTARTED = "The kernel was restarted, all variables were lost."
+_CONNECTION_LOST = (
+    "The connection to the kernel was lost while the code was running, so its "
+    "output is incomplete. The code may still have run to the end."
+)
+
+
+def _deadline(timeout: Optional[float]) -> Optional[float]:
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def _is_idle(received_msg: dict) -> bool:
+    return (
+            received_msg["header"]["msg_type"] == "status"
+            and received_msg["content"]["execution_state"] == "idle"
+    )
+
+
+def _is_started(received_msg: dict, cancelled: bool) -> bool:
+    # the kernel goes busy for each request it takes up, even one it then
+    # aborts; execute_input is only sent for code that actually runs
+    msg_type = received_msg["header"]["msg_type"]
+    if msg_type == "execute_input":
+        return True
+    return (
+            not cancelled
+            and msg_type == "status"
+            and received_msg["content"]["execution_state"] == "busy"
+    )
+
+
+def _is_aborted(received_msg: dict) -> bool:
+    return (
+            received_msg["header"]["msg_type"] == "execute_reply"
+            and received_msg["content"].get("status") == "aborted"
+    )
+
+
+def _timeout_event(timeout: float, restarted: bool, started: bool = True) -> CodeBoxEvent:
+    if not started:
+        content = (
+            f"Execution did not start within {timeout}s because the kernel was busy "
+            "with other code, and was cancelled."
+        )
+    elif restarted:
+        content = (
+            f"Execution timed out after {timeout}s. The kernel did not respond to "
+            "the interrupt and was restarted, all variables were lost."
+        )
+    else:
+        content = f"Execution timed out after {timeout}s and was interrupted."
+    return CodeBoxEvent(type="timeout", content=content, data={"restarted": restarted})
+
+
+class _OutputCollector:
+    """Folds the events of one execution into the single CodeBoxOutput of `run()`.
+
+    Rich MIME outputs are decoded straight into files in the workspace. Their
+    text/plain repr still goes into the output, unless the file is a binary
+    image or pdf, whose repr says nothing (`<Figure size 640x480>`); then the
+    output names the file instead. The payload itself never ends up there.
+    """
+
+    def __init__(self, workspace: str, head_size: int, tail_size: int) -> None:
+        self.workspace = workspace
+        self.prefix = f"output_{uuid4().hex[:8]}"
+        self.spill_name = f"{self.prefix}.txt"
+        self.result = OutputBuffer(
+            head_size, tail_size, os.path.join(workspace, self.spill_name)
+        )
+        self.files: List[str] = []
+        self.error: Optional[str] = None
+        self.timeout: Optional[str] = None
+
+    def add(self, event: CodeBoxEvent) -> None:
+        if event.type == "stream":
+            msg = event.content.strip()
+            if "Requirement already satisfied:" not in msg:
+                self.result.write(msg + "\n")
+        elif event.type in ("execute_result", "display_data"):
+            file_name, binary = self._save_rich_output(event.data)
+            if file_name is not None:
+                self.files.append(file_name)
+            if "text/plain" in event.data and not binary:
+                self.result.write(event.content.strip() + "\n")
+            elif file_name is not None:
+                self.result.write(f"[{event.type} saved to {file_name}]\n")
+            else:
+                mime_types = ", ".join(event.data)
+                self.result.write(f"[{event.type} of unsupported type {mime_types}]\n")
+        elif event.type == "error" and self.error is None:
+            self.error = event.content
+        elif event.type == "timeout":
+            self.timeout = event.content
+
+    def close(self) -> None:
+        self.result.close()
+        if self.result.spilled and self.spill_name not in self.files:
+            self.files.append(self.spill_name)
+
+    def output(self) -> CodeBoxOutput:
+        if self.timeout is not None:
+            result = self.result.getvalue(self.spill_name)
+            return CodeBoxOutput(
+                type="timeout", content=f"{result}{self.timeout}", files=self.files
+            )
+        if self.error is not None:
+            return CodeBoxOutput(type="error", content=self.error, files=self.files)
+        result = self.result.getvalue(self.spill_name)
+        return CodeBoxOutput(
+            type="text",
+            content=result or "code run successfully (no output)",
+            files=self.files,
+            raw_file=self.spill_name if self.result.spilled else None,
+        )
+
+    def _save_rich_output(self, data: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+        # the saved file's name, and whether it is binary
+        for mime_type, (extension, encoding) in _RICH_MIME_TYPES.items():
+            if mime_type not in data:
+                continue
+            file_name = f"{self.prefix}_{len(self.files) + 1}.{extension}"
+            path = os.path.join(self.workspace, file_name)
+            payload = data[mime_type]
+            if encoding == "base64":
+                with open(path, "wb") as f:
+                    _write_base64(f, payload)
+            else:
+                if encoding == "json":
+                    payload = json.dumps(payload)
+                elif isinstance(payload, list):
+                    payload = "".join(payload)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(payload)
+            return file_name, encoding == "base64"
+        return None, False
+
+
+# first match wins, so a figure is stored as png rather than as its svg or text repr
+_RICH_MIME_TYPES = {
+    "image/png": ("png", "base64"),
+    "image/jpeg": ("jpeg", "base64"),
+    "image/gif": ("gif", "base64"),
+    "application/pdf": ("pdf", "base64"),
+    "image/svg+xml": ("svg", "text"),
+    "text/html": ("html", "text"),
+    "text/markdown": ("md", "text"),
+    "application/json": ("json", "json"),
+}
+
+
+def _write_base64(f, payload: str, chunk_size: int = 1 << 18) -> None:
+    # decode slice by slice so the decoded image never exists twice in memory
+    if "\n" in payload:
+        payload = "".join(payload.split())
+    for i in range(0, len(payload), chunk_size):
+        f.write(binascii.a2b_base64(payload[i:i + chunk_size]))
@@ -0,0 +1,81 @@
+from collections import deque
+from typing import Deque, List, Optional, TextIO
+
+
+class OutputBuffer:
+    """Keeps the first `head_size` and last `tail_size` characters of an output.
+
+    Memory stays constant however much is written. Once characters start being
+    dropped from the middle, everything (including what was already buffered)
+    is written to `spill_path` so the full output is still available.
+    """
+
+    def __init__(
+            self,
+            head_size: int = 250,
+            tail_size: int = 500,
+            spill_path: Optional[str] = None,
+    ) -> None:
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.spill_path = spill_path
+        self.total = 0
+        self.dropped = 0
+        self._head: List[str] = []
+        self._head_len = 0
+        self._tail: Deque[str] = deque()
+        self._tail_len = 0
+        self._spill: Optional[TextIO] = None
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+        self.total += len(text)
+        if self._spill is not None:
+            self._spill.write(text)
+
+        if self._head_len < self.head_size:
+            taken = text[:self.head_size - self._head_len]
+            self._head.append(taken)
+            self._head_len += len(taken)
+            text = text[len(taken):]
+            if not text:
+                return
+
+        self._tail.append(text)
+        self._tail_len += len(text)
+        excess = self._tail_len - self.tail_size
+        if excess > 0 and self._spill is None and self.spill_path is not None:
+            # nothing has been dropped yet, so head + tail is the whole output
+            self._spill = open(self.spill_path, "w", encoding="utf-8")
+            self._spill.writelines(self._head)
+            self._spill.writelines(self._tail)
+        while excess > 0:
+            first = self._tail[0]
+            if len(first) <= excess:
+                self._tail.popleft()
+                dropped = len(first)
+            else:
+                self._tail[0] = first[excess:]
+                dropped = excess
+            self._tail_len -= dropped
+            self.dropped += dropped
+            excess -= dropped
+
+    def getvalue(self, spill_name: Optional[str] = None) -> str:
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        if not self.dropped:
+            return head + tail
+        note = f"{self.dropped} characters truncated"
+        if self.spilled:
+            note += f", full output saved to {spill_name or self.spill_path}"
+        return f"{head}\n[... {note} ...]\n{tail}"
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
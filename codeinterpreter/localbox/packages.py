@@ -0,0 +1,149 @@
+import fcntl
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set
+
+from loguru import logger
+
+# import names that differ from the name the package is published under
+MODULE_TO_DISTRIBUTION = {
+    "attr": "attrs",
+    "bs4": "beautifulsoup4",
+    "Crypto": "pycryptodome",
+    "cv2": "opencv-python",
+    "dateutil": "python-dateutil",
+    "docx": "python-docx",
+    "dotenv": "python-dotenv",
+    "fitz": "PyMuPDF",
+    "jwt": "PyJWT",
+    "Levenshtein": "python-Levenshtein",
+    "magic": "python-magic",
+    "osgeo": "GDAL",
+    "PIL": "Pillow",
+    "pptx": "python-pptx",
+    "serial": "pyserial",
+    "skimage": "scikit-image",
+    "sklearn": "scikit-learn",
+    "yaml": "PyYAML",
+}
+
+wheelhouse_path = os.getenv(
+    "CODEBOX_WHEELHOUSE",
+    os.path.join(os.environ.get('HOME'), "Desktop/codeinterpreter/wheelhouse"),
+)
+
+
+def distribution_for(module_name: str) -> str:
+    top_level = module_name.split(".")[0]
+    return MODULE_TO_DISTRIBUTION.get(top_level, top_level)
+
+
+class PackageCache:
+    """Installs packages into the kernels' environment from a shared wheelhouse.
+
+    All kernels run on the same interpreter, so one install serves every
+    session. Installs first try the wheelhouse alone (`--no-index`) and only
+    build/download wheels into it when that fails and `offline` is off.
+    Concurrent requests for the same distribution wait for a single install,
+    and installs from every process sharing the wheelhouse (the app and the
+    server) take turns through a lock file in it.
+    """
+
+    def __init__(
+            self,
+            wheelhouse: str = wheelhouse_path,
+            offline: bool = False,
+            python: str = sys.executable,
+    ) -> None:
+        self.wheelhouse = wheelhouse
+        self.offline = offline
+        self.python = python
+        self._installed: Set[str] = set()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def install(self, package_name: str) -> str:
+        distribution = distribution_for(package_name)
+        with self._lock:
+            if distribution in self._installed:
+                return distribution
+            future = self._inflight.get(distribution)
+            owner = future is None
+            if owner:
+                future = self._inflight[distribution] = Future()
+        if not owner:
+            logger.info("Waiting for the running install of {}", distribution)
+            return future.result()
+
+        try:
+            self._install(distribution)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(distribution)
+            with self._lock:
+                self._installed.add(distribution)
+        finally:
+            with self._lock:
+                self._inflight.pop(distribution, None)
+        return distribution
+
+    def _install(self, distribution: str) -> None:
+        with self._wheelhouse_lock():
+            self._install_locked(distribution)
+
+    @contextmanager
+    def _wheelhouse_lock(self) -> Iterator[None]:
+        os.makedirs(self.wheelhouse, exist_ok=True)
+        with open(os.path.join(self.wheelhouse, ".lock"), "w") as f:
+            # held across pip runs; another process may have installed the
+            # distribution meanwhile, then the --no-index install finds it
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _install_locked(self, distribution: str) -> None:
+        install = ["install", "-q", "--no-index", "--find-links", self.wheelhouse, distribution]
+        if self._pip(install) is None:
+            logger.info("Installed {} from the wheelhouse", distribution)
+            return
+        if self.offline:
+            raise RuntimeError(f"{distribution} is not available in the wheelhouse")
+
+        logger.info("Adding {} to the wheelhouse...", distribution)
+        error = self._pip(["wheel", "-q", "--wheel-dir", self.wheelhouse, distribution])
+        if error is not None:
+            raise RuntimeError(f"Could not download {distribution}: {error}")
+        error = self._pip(install)
+        if error is not None:
+            raise RuntimeError(f"Could not install {distribution}: {error}")
+
+    def _pip(self, args: List[str]) -> Optional[str]:
+        result = subprocess.run(
+            [self.python, "-m", "pip", *args],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode == 0:
+            return None
+        lines = result.stderr.strip().splitlines()
+        return lines[-1] if lines else f"pip exited with code {result.returncode}"
+
+
+_default_cache: Optional[PackageCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_package_cache() -> PackageCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PackageCache(offline=os.getenv("CODEBOX_PIP_OFFLINE") == "1")
+        return _default_cache
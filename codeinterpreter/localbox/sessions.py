@@ -0,0 +1,245 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import psutil
+from loguru import logger
+
+from .kernel_pool import KernelPool
+from .localbox import LocalBox
+
+
+class _Session:
+    def __init__(self, key: str, box: LocalBox) -> None:
+        self.key = key
+        self.box = box
+        # one turn at a time per chat
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry:
+    """Keeps one kernel per chat alive across turns.
+
+    Kernels come from the `KernelPool` and stay with their chat until they are
+    evicted: least recently used first once `max_sessions` is reached or the
+    host runs short of memory, or after `idle_timeout` seconds without a turn.
+    An evicted kernel's namespace is snapshotted first, and restored into the
+    next kernel that chat gets, so evictions cost a reload, not the loaded data.
+
+    With `workspace_root` set, every session works in its own directory below
+    it instead of the shared workspace.
+    """
+
+    def __init__(
+            self,
+            kernel_pool: Optional[KernelPool] = None,
+            max_sessions: int = 4,
+            idle_timeout: float = 1800.0,
+            max_memory_percent: float = 85.0,
+            sweep_interval: float = 30.0,
+            workspace_root: Optional[str] = None,
+    ) -> None:
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1")
+        self.kernel_pool = kernel_pool or KernelPool(max_size=max_sessions)
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_memory_percent = max_memory_percent
+        self.sweep_interval = sweep_interval
+        self.workspace_root = workspace_root
+        # least recently used first
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        # sessions whose snapshot is still being written
+        self._evicting: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._sweeper = threading.Thread(
+            target=self._sweep_loop, name="session-sweeper", daemon=True
+        )
+        self._sweeper.start()
+
+    @contextmanager
+    def session(self, key) -> Iterator[LocalBox]:
+        box = self.acquire(key)
+        try:
+            yield box
+        finally:
+            self.release(key)
+
+    def acquire(self, key) -> LocalBox:
+        key = str(key)
+        while True:
+            with self._lock:
+                if self._closed.is_set():
+                    raise RuntimeError("Session registry is closed")
+                evicting = self._evicting.get(key)
+                session = self._sessions.get(key)
+                if evicting is None and session is not None:
+                    session.in_use += 1
+                    self._sessions.move_to_end(key)
+            if evicting is not None:
+                evicting.wait()
+                continue
+            if session is None:
+                session = self._create(key)
+                if session is None:
+                    # another turn of the same chat created it first
+                    continue
+                return session.box
+            session.lock.acquire()
+            session.last_used = time.monotonic()
+            return session.box
+
+    def release(self, key) -> None:
+        key = str(key)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                return
+            session.in_use -= 1
+            session.last_used = time.monotonic()
+        session.lock.release()
+
+    def evict(self, key, snapshot: bool = True) -> bool:
+        key = str(key)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session.in_use:
+                return False
+            del self._sessions[key]
+            done = self._evicting[key] = threading.Event()
+        try:
+            if snapshot:
+                self._snapshot(session)
+            self.kernel_pool.release(session.box)
+        finally:
+            with self._lock:
+                del self._evicting[key]
+            done.set()
+        logger.info("Evicted the kernel of session {}", key)
+        return True
+
+    def workspace(self, key) -> Optional[str]:
+        if self.workspace_root is None:
+            return None
+        return os.path.join(self.workspace_root, _file_name(str(key)))
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._sessions)
+
+    def close(self) -> None:
+        self._closed.set()
+        for key in self.keys():
+            self.evict(key)
+        self.kernel_pool.close()
+
+    def _create(self, key: str) -> Optional[_Session]:
+        # returns the new session already locked for the caller, so no other
+        # turn can run on it while the snapshot is being restored
+        while len(self.keys()) >= self.max_sessions:
+            if not self._evict_lru():
+                break
+        box = self._acquire_box()
+        with self._lock:
+            if key in self._sessions or key in self._evicting:
+                self.kernel_pool.release(box)
+                return None
+            session = self._sessions[key] = _Session(key, box)
+            session.in_use += 1
+            session.lock.acquire()
+        try:
+            workspace = self.workspace(key)
+            if workspace is not None:
+                box.chdir(workspace)
+            self._restore(session)
+        except BaseException:
+            with self._lock:
+                del self._sessions[key]
+            session.lock.release()
+            self.kernel_pool.release(box)
+            raise
+        return session
+
+    def _acquire_box(self) -> LocalBox:
+        # every pool kernel may be held by another chat: make room by evicting
+        # idle sessions until one comes back
+        while True:
+            try:
+                return self.kernel_pool.acquire(timeout=1.0)
+            except TimeoutError:
+                if not self._evict_lru():
+                    logger.info("All kernels are busy, waiting for a free one...")
+
+    def _evict_lru(self) -> bool:
+        for key in self.keys():
+            if self.evict(key):
+                return True
+        return False
+
+    def _snapshot(self, session: _Session) -> None:
+        try:
+            session.box.snapshot(self._snapshot_path(session))
+        except Exception as e:
+            logger.warning("Could not snapshot session {}: {}", session.key, e)
+
+    def _restore(self, session: _Session) -> None:
+        path = self._snapshot_path(session)
+        if not os.path.exists(path):
+            return
+        try:
+            session.box.restore(path)
+        except Exception as e:
+            logger.warning("Could not restore session {}: {}", session.key, e)
+
+    @staticmethod
+    def _snapshot_path(session: _Session) -> str:
+        name = _file_name(session.key)
+        return os.path.join(session.box.workspace, ".codebox", "sessions", f"{name}.pkl")
+
+    def _sweep_loop(self) -> None:
+        while not self._closed.wait(self.sweep_interval):
+            try:
+                self._sweep()
+            except Exception as e:
+                logger.warning("Session sweep failed: {}", e)
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                key for key, session in self._sessions.items()
+                if not session.in_use and now - session.last_used > self.idle_timeout
+            ]
+        for key in expired:
+            self.evict(key)
+
+        # one at a time: the pool stops evicted kernels in the background, so
+        # their memory only shows up as free by the next sweep
+        if (
+                self.max_memory_percent
+                and psutil.virtual_memory().percent > self.max_memory_percent
+        ):
+            logger.warning(
+                "Memory usage above {}%, evicting the least recently used session",
+                self.max_memory_percent,
+            )
+            self._evict_lru()
+
+
+def _file_name(key: str) -> str:
+    # keys that are already safe keep their name; the others get a hash of
+    # the full key after a ".", which no safe name contains, so "chat 1" and
+    # "chat_1" never share a snapshot or a workspace
+    safe = re.sub(r"[^\w-]", "_", key)[:64]
+    if safe and safe == key:
+        return key
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+    return f"{safe or 'session'}.{digest}"
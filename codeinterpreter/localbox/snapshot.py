@@ -0,0 +1,131 @@
+import os
+from typing import Dict, List
+
+from pydantic import BaseModel
+
+MAX_OBJECT_BYTES = int(os.getenv("CODEBOX_SNAPSHOT_MAX_OBJECT_MB", "256")) * 1024 * 1024
+MAX_TOTAL_BYTES = int(os.getenv("CODEBOX_SNAPSHOT_MAX_TOTAL_MB", "1024")) * 1024 * 1024
+
+
+class SnapshotReport(BaseModel):
+    path: str
+    # names that were saved/restored, and modules bound to a name (`import numpy as np`)
+    objects: List[str] = []
+    modules: List[str] = []
+    # name -> why it was left out
+    skipped: Dict[str, str] = {}
+    bytes: int = 0
+
+
+# Both snippets run inside the kernel. Each object is serialised on its own
+# (dill when installed, pickle otherwise) so one unpicklable or oversized
+# value only loses itself, and the writer gives up as soon as a value grows
+# past its limit instead of building it in memory first. Without dill,
+# functions and classes defined in the notebook cannot be pickled by value,
+# so their source is kept instead and re-executed before anything else.
+_SNAPSHOT_CODE = '''
+def __codebox_snapshot(path, max_object_bytes, max_total_bytes):
+    import inspect, io, json, os, pickle, types
+    try:
+        import dill as pickler
+    except ImportError:
+        pickler = pickle
+
+    class TooLarge(Exception):
+        pass
+
+    class Capped(io.BytesIO):
+        def __init__(self, limit):
+            super().__init__()
+            self.limit = limit
+
+        def write(self, data):
+            if self.tell() + len(data) > self.limit:
+                raise TooLarge()
+            return super().write(data)
+
+    ip = get_ipython()
+    hidden = set(ip.user_ns_hidden) | {"In", "Out", "exit", "quit", "get_ipython"}
+    objects, modules, sources, skipped, total = {}, {}, {}, {}, 0
+    for name, value in list(ip.user_ns.items()):
+        if name.startswith("_") or name in hidden:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        if (pickler is pickle and isinstance(value, (types.FunctionType, type))
+                and value.__module__ == "__main__"):
+            try:
+                sources[name] = inspect.getsource(value)
+            except (OSError, TypeError) as e:
+                skipped[name] = f"{type(e).__name__}: {e}"[:200]
+            continue
+        limit = min(max_object_bytes, max_total_bytes - total)
+        buffer = Capped(limit)
+        try:
+            pickler.dump(value, buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        except TooLarge:
+            skipped[name] = f"larger than the {limit} bytes left for it"
+            continue
+        except Exception as e:
+            skipped[name] = f"{type(e).__name__}: {e}"[:200]
+            continue
+        objects[name] = buffer.getvalue()
+        total += len(objects[name])
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".part", "wb") as f:
+        pickle.dump({"modules": modules, "sources": sources, "objects": objects}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".part", path)
+    with open(path + ".json", "w") as f:
+        json.dump({"path": path, "objects": sorted([*objects, *sources]), "modules": sorted(modules),
+                   "skipped": skipped, "bytes": total}, f)
+'''
+
+_RESTORE_CODE = '''
+def __codebox_restore(path):
+    import importlib, json, pickle
+    try:
+        import dill as pickler
+    except ImportError:
+        pickler = pickle
+
+    with open(path, "rb") as f:
+        snapshot = pickle.load(f)
+    ns = get_ipython().user_ns
+    restored, modules, skipped, total = [], [], {}, 0
+    for name, module in snapshot["modules"].items():
+        try:
+            ns[name] = importlib.import_module(module)
+            modules.append(name)
+        except Exception as e:
+            skipped[name] = f"{type(e).__name__}: {e}"[:200]
+    for name, source in snapshot["sources"].items():
+        try:
+            exec(source, ns)
+            restored.append(name)
+        except Exception as e:
+            skipped[name] = f"{type(e).__name__}: {e}"[:200]
+    for name, data in snapshot["objects"].items():
+        try:
+            ns[name] = pickler.loads(data)
+            restored.append(name)
+            total += len(data)
+        except Exception as e:
+            skipped[name] = f"{type(e).__name__}: {e}"[:200]
+    with open(path + ".json", "w") as f:
+        json.dump({"path": path, "objects": restored, "modules": modules,
+                   "skipped": skipped, "bytes": total}, f)
+'''
+
+
+def snapshot_code(path: str, max_object_bytes: int, max_total_bytes: int) -> str:
+    return (
+        f"{_SNAPSHOT_CODE}\n"
+        f"__codebox_snapshot({path!r}, {max_object_bytes}, {max_total_bytes})\n"
+        "del __codebox_snapshot\n"
+    )
+
+
+def restore_code(path: str) -> str:
+    return f"{_RESTORE_CODE}\n__codebox_restore({path!r})\ndel __codebox_restore\n"
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import psutil
+from loguru import logger
+from websockets.client import WebSocketClientProtocol
+
+if TYPE_CHECKING:
+    from .localbox import LocalBox
+
+# every gateway (and, through inheritance, every kernel) is started with this
+# variable set to "<pid>:<create_time>" of the app process that owns it
+OWNER_ENV = "CODEINTERPRETER_OWNER"
+
+
+def owner_marker() -> str:
+    return f"{os.getpid()}:{psutil.Process().create_time()}"
+
+
+def _owner_alive(marker: str) -> bool:
+    try:
+        pid, create_time = marker.split(":")
+        return psutil.Process(int(pid)).create_time() == float(create_time)
+    except (ValueError, psutil.Error):
+        return False
+
+
+def reap_orphaned_processes() -> int:
+    """Kill gateways and kernels left behind by app processes that no longer exist."""
+    reaped = 0
+    for proc in psutil.process_iter(["pid", "cmdline"]):
+        if proc.pid == os.getpid():
+            continue
+        cmdline = " ".join(proc.info["cmdline"] or [])
+        if "kernelgateway" not in cmdline and "ipykernel" not in cmdline:
+            continue
+        try:
+            marker = proc.environ().get(OWNER_ENV)
+        except psutil.Error:
+            continue
+        if marker is None or _owner_alive(marker):
+            continue
+        logger.warning("Reaping orphaned kernel process {}: {}", proc.pid, cmdline)
+        try:
+            proc.kill()
+            reaped += 1
+        except psutil.Error:
+            pass
+    return reaped
+
+
+class _Tracked:
+    def __init__(self, box: "LocalBox") -> None:
+        self.box = box
+        self.process: Optional[psutil.Process] = None
+        # kept between samples: cpu_percent measures since the previous call
+        # on the same Process object
+        self.children: Dict[int, psutil.Process] = {}
+        self.cpu_strikes = 0
+        self.rss = 0
+        self.cpu_percent = 0.0
+
+
+class KernelSupervisor:
+    """Samples the RSS and CPU of every running kernel and restarts the ones
+    that stay over the configured limits.
+
+    A limit of 0 disables it. CPU has to be exceeded for `cpu_grace_samples`
+    consecutive samples so a short burst of work is not punished.
+    """
+
+    def __init__(
+            self,
+            max_rss_mb: int = 8192,
+            max_cpu_percent: float = 0,
+            cpu_grace_samples: int = 12,
+            interval: float = 5.0,
+    ) -> None:
+        self.max_rss_mb = max_rss_mb
+        self.max_cpu_percent = max_cpu_percent
+        self.cpu_grace_samples = cpu_grace_samples
+        self.interval = interval
+        self._tracked: Dict[str, _Tracked] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, box: "LocalBox") -> None:
+        with self._lock:
+            self._tracked[box.kernel_id] = _Tracked(box)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._watch, name="kernel-supervisor", daemon=True
+                )
+                self._thread.start()
+
+    def unregister(self, box: "LocalBox") -> None:
+        with self._lock:
+            self._tracked.pop(box.kernel_id, None)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            tracked = list(self._tracked.items())
+        return [
+            {
+                "session_id": str(t.box.session_id),
+                "kernel_id": kernel_id,
+                "pid": t.process.pid if t.process else None,
+                "rss_mb": t.rss // (1024 * 1024),
+                "cpu_percent": t.cpu_percent,
+            }
+            for kernel_id, t in tracked
+        ]
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                tracked = list(self._tracked.items())
+            for kernel_id, t in tracked:
+                try:
+                    self._sample(kernel_id, t)
+                except Exception as e:
+                    logger.warning("Could not sample kernel {}: {}", kernel_id, e)
+
+    def _sample(self, kernel_id: str, t: _Tracked) -> None:
+        if t.process is None or not t.process.is_running():
+            t.process = self._find_kernel_process(t.box)
+            if t.process is None:
+                return
+            t.children = {}
+            # the first cpu_percent call only sets the baseline
+            t.process.cpu_percent(None)
+            return
+
+        # whatever the code started (subprocesses, worker pools) counts too
+        t.children = {
+            child.pid: t.children.get(child.pid, child)
+            for child in t.process.children(recursive=True)
+        }
+        processes = [t.process, *t.children.values()]
+        t.rss = sum(_safe(lambda p: p.memory_info().rss, p, 0) for p in processes)
+        t.cpu_percent = sum(_safe(lambda p: p.cpu_percent(None), p, 0.0) for p in processes)
+
+        reason = None
+        if self.max_rss_mb and t.rss > self.max_rss_mb * 1024 * 1024:
+            reason = (
+                f"The kernel used {t.rss // (1024 * 1024)} MB, more than the "
+                f"{self.max_rss_mb} MB limit, and was restarted. All variables were lost."
+            )
+        if self.max_cpu_percent and t.cpu_percent > self.max_cpu_percent:
+            t.cpu_strikes += 1
+            if t.cpu_strikes >= self.cpu_grace_samples:
+                reason = (
+                    f"The kernel stayed above {self.max_cpu_percent}% CPU for too long "
+                    "and was restarted. All variables were lost."
+                )
+        else:
+            t.cpu_strikes = 0
+
+        if reason is not None:
+            logger.warning("Kernel {} over limits: {}", kernel_id, reason)
+            self._restart(t.box, reason)
+            t.process = None
+            t.cpu_strikes = 0
+
+    @staticmethod
+    def _restart(box: "LocalBox", reason: str) -> None:
+        if isinstance(box.ws, WebSocketClientProtocol):
+            future = asyncio.run_coroutine_threadsafe(box.arestart(reason), box.loop)
+            future.result()
+        else:
+            box.restart(reason)
+
+    @staticmethod
+    def _find_kernel_process(box: "LocalBox") -> Optional[psutil.Process]:
+        if box.gateway is None or box.kernel_id is None:
+            return None
+        try:
+            children = psutil.Process(box.gateway.pid).children(recursive=True)
+        except psutil.Error:
+            return None
+        # kernels are launched with a connection file named after their id
+        for child in children:
+            if any(box.kernel_id in arg for arg in _safe(psutil.Process.cmdline, child, [])):
+                return child
+        return None
+
+
+def _safe(fn, proc: psutil.Process, default):
+    try:
+        return fn(proc)
+    except psutil.Error:
+        return default
+
+
+_default_supervisor: Optional[KernelSupervisor] = None
+_default_supervisor_lock = threading.Lock()
+
+
+def get_supervisor() -> KernelSupervisor:
+    global _default_supervisor
+    with _default_supervisor_lock:
+        if _default_supervisor is None:
+            _default_supervisor = KernelSupervisor(
+                max_rss_mb=int(os.getenv("KERNEL_MAX_RSS_MB", "8192")),
+                max_cpu_percent=float(os.getenv("KERNEL_MAX_CPU_PERCENT", "0")),
+            )
+        return _default_supervisor
@@ -0,0 +1,57 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+# relative path -> (size, mtime_ns)
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+class FileChanges(BaseModel):
+    created: List[str] = []
+    modified: List[str] = []
+
+    @property
+    def files(self) -> List[str]:
+        return self.created + self.modified
+
+
+class WorkspaceWatcher:
+    """Detects the files an execution wrote by comparing workspace snapshots.
+
+    Hidden files and directories (dot-prefixed) and in-progress uploads
+    (`*.part`) are ignored.
+    """
+
+    def __init__(self, workspace: str) -> None:
+        self.workspace = workspace
+
+    def snapshot(self) -> Snapshot:
+        snapshot: Snapshot = {}
+        if os.path.isdir(self.workspace):
+            self._scan(self.workspace, "", snapshot)
+        return snapshot
+
+    def changes(self, before: Snapshot, after: Optional[Snapshot] = None) -> FileChanges:
+        if after is None:
+            after = self.snapshot()
+        changes = FileChanges()
+        for path, stat in after.items():
+            previous = before.get(path)
+            if previous is None:
+                changes.created.append(path)
+            elif previous != stat:
+                changes.modified.append(path)
+        return changes
+
+    def _scan(self, directory: str, prefix: str, snapshot: Snapshot) -> None:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or entry.name.endswith(".part"):
+                    continue
+                name = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    self._scan(entry.path, name + os.sep, snapshot)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    snapshot[name] = (stat.st_size, stat.st_mtime_ns)
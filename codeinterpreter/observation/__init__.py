@@ -0,0 +1,5 @@
+from .compressor import ObservationCompressor
+
+__all__ = [
+    "ObservationCompressor"
+]
@@ -0,0 +1,183 @@
+import os
+import re
+import statistics
+from typing import List
+
+DEFAULT_MAX_TOKENS = int(os.getenv("OBSERVATION_MAX_TOKENS", "400"))
+
+_NUMBER = r"[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?"
+# a bracketed run of numbers, e.g. a list or the body of a numpy array repr
+_NUMBER_LIST = re.compile(rf"\[\s*{_NUMBER}(?:[,\s]+{_NUMBER})*,?\s*\]")
+_DATAFRAME_SHAPE = re.compile(r"^\[(\d+) rows x (\d+) columns\]$")
+_SERIES_FOOTER = re.compile(r"^(?:Name: .*, )?(?:Length: \d+, )?dtype: \w+$")
+_TRACEBACK_START = "Traceback (most recent call last):"
+_FRAME = re.compile(r'^\s+File "')
+
+
+class ObservationCompressor:
+    """Shortens tool output before it is sent back to the LLM.
+
+    Common shapes are summarised instead of cut blindly: DataFrame and Series
+    reprs keep their header, first and last rows and shape, tracebacks keep
+    their last frames and the exception, long runs of numbers become their
+    count, range and mean, and repeated log lines are counted. Whatever is
+    still over `max_tokens` (about 4 characters each) loses its middle lines.
+    """
+
+    def __init__(
+            self,
+            max_tokens: int = DEFAULT_MAX_TOKENS,
+            preview_rows: int = 5,
+            max_line_chars: int = 200,
+            min_numbers: int = 20,
+            min_repeats: int = 8,
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.preview_rows = preview_rows
+        self.max_line_chars = max_line_chars
+        self.min_numbers = min_numbers
+        self.min_repeats = min_repeats
+
+    @property
+    def max_chars(self) -> int:
+        return self.max_tokens * 4
+
+    def compress(self, text: str) -> str:
+        if len(text) <= self.max_chars:
+            return text
+        text = _NUMBER_LIST.sub(self._summarise_numbers, text)
+        lines = text.split("\n")
+        lines = self._compress_tracebacks(lines)
+        lines = self._compress_tables(lines)
+        lines = self._collapse_repeats(lines)
+        lines = [self._clip(line) for line in lines]
+        return self._fit("\n".join(lines))
+
+    def compress_file(self, path: str, max_bytes: int = 4 * 1024 * 1024) -> str:
+        """Compresses the text in `path`, reading at most its first and last
+        `max_bytes / 2` bytes."""
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            if size <= max_bytes:
+                return self.compress(f.read().decode("utf-8", "replace"))
+            head = f.read(max_bytes // 2).decode("utf-8", "replace")
+            f.seek(size - max_bytes // 2)
+            tail = f.read().decode("utf-8", "replace")
+        skipped = size - 2 * (max_bytes // 2)
+        return self.compress(f"{head}\n[... {skipped} bytes not read ...]\n{tail}")
+
+    def _summarise_numbers(self, match: re.Match) -> str:
+        numbers = re.findall(_NUMBER, match.group(0))
+        if len(numbers) < self.min_numbers:
+            return match.group(0)
+        values = [float(n) for n in numbers]
+        return (
+            f"[{len(values)} numbers, min {min(values):g}, max {max(values):g}, "
+            f"mean {statistics.fmean(values):g}; first {', '.join(numbers[:3])}"
+            f" ... last {', '.join(numbers[-3:])}]"
+        )
+
+    def _compress_tracebacks(self, lines: List[str]) -> List[str]:
+        result: List[str] = []
+        i = 0
+        while i < len(lines):
+            if lines[i].strip() != _TRACEBACK_START:
+                result.append(lines[i])
+                i += 1
+                continue
+            # a traceback runs until the first unindented line, the exception
+            end = i + 1
+            while end < len(lines) and (not lines[end] or lines[end][0].isspace()):
+                end += 1
+            body = lines[i + 1:end]
+            frames = [j for j, line in enumerate(body) if _FRAME.match(line)]
+            result.append(lines[i])
+            if len(frames) > 3:
+                # the caller's frame and the innermost two say where it went wrong
+                result.extend(body[:frames[1]])
+                result.append(f"  [... {len(frames) - 3} frames omitted ...]")
+                result.extend(body[frames[-2]:])
+            else:
+                result.extend(body)
+            if end < len(lines):
+                result.append(lines[end])
+            i = end + 1
+        return result
+
+    def _compress_tables(self, lines: List[str]) -> List[str]:
+        result: List[str] = []
+        block: List[str] = []
+        previous: List[str] = []
+        for line in lines:
+            if not line.strip():
+                result.extend(block)
+                previous, block = block, []
+                result.append(line)
+                continue
+            if _DATAFRAME_SHAPE.match(line.strip()) and not block and previous:
+                # DataFrame reprs put a blank line between the rows and the shape
+                del result[-len(previous) - 1:]
+                result.extend(self._preview_table([*previous, ""]))
+                result.append(line)
+                previous = []
+                continue
+            block.append(line)
+            if _DATAFRAME_SHAPE.match(line.strip()) or _SERIES_FOOTER.match(line.strip()):
+                result.extend(self._preview_table(block))
+                block = []
+            previous = []
+        result.extend(block)
+        return result
+
+    def _preview_table(self, block: List[str]) -> List[str]:
+        # the header, the first and last rows, and the footer with the shape
+        *rows, footer = block
+        keep = 2 * self.preview_rows + 1
+        if len(rows) <= keep + 1:
+            return block
+        head, tail = rows[:self.preview_rows + 1], rows[-self.preview_rows:]
+        omitted = len(rows) - len(head) - len(tail)
+        return [*head, f"[... {omitted} rows omitted ...]", *tail, footer]
+
+    def _collapse_repeats(self, lines: List[str]) -> List[str]:
+        # lines that only differ in their numbers (counters, timestamps) count as repeats
+        result: List[str] = []
+        i = 0
+        while i < len(lines):
+            shape = re.sub(r"\d+", "#", lines[i])
+            end = i + 1
+            while end < len(lines) and re.sub(r"\d+", "#", lines[end]) == shape:
+                end += 1
+            run = end - i
+            if run >= self.min_repeats and lines[i].strip():
+                result.extend([lines[i], f"[... {run - 2} similar lines omitted ...]", lines[end - 1]])
+            else:
+                result.extend(lines[i:end])
+            i = end
+        return result
+
+    def _clip(self, line: str) -> str:
+        if len(line) <= self.max_line_chars:
+            return line
+        return f"{line[:self.max_line_chars]}[... {len(line) - self.max_line_chars} more]"
+
+    def _fit(self, text: str) -> str:
+        if len(text) <= self.max_chars:
+            return text
+        # the end of an output (results, errors) tends to matter more than its
+        # start; whole lines go, so the cut never lands inside a frame or a row
+        lines = text.split("\n")
+        head = _take_lines(lines, self.max_chars // 3)
+        tail = _take_lines(lines[len(head):][::-1], self.max_chars - self.max_chars // 3)[::-1]
+        omitted = len(lines) - len(head) - len(tail)
+        return "\n".join([*head, f"[... {omitted} lines omitted ...]", *tail])
+
+
+def _take_lines(lines: List[str], max_chars: int) -> List[str]:
+    taken: List[str] = []
+    for line in lines:
+        max_chars -= len(line) + 1
+        if max_chars < 0:
+            break
+        taken.append(line)
+    return taken
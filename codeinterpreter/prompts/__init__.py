@@ -1,7 +1,6 @@
-from .prompts import system_message, remove_dl_link_prompt, determine_modifications_prompt
+from .prompts import system_message, remove_dl_link_prompt
 
 __all__ = [
-    "determine_modifications_prompt",
     "remove_dl_link_prompt",
     "system_message",
 ]
@@ -1,3 +1,6 @@
+from io import BytesIO
+from typing import Any, BinaryIO, Optional
+
 from langchain.pydantic_v1 import BaseModel
 from langchain.schema import HumanMessage, AIMessage
 from loguru import logger
@@ -5,15 +8,43 @@ from loguru import logger
 
 class File(BaseModel):
     name: str
-    content: bytes
+    # exactly one of these holds the data; `path` and `stream` are read lazily
+    content: Optional[bytes] = None
+    path: Optional[str] = None
+    stream: Optional[Any] = None
 
     @classmethod
     def from_path(cls, path: str):
         if not path.startswith("/"):
             path = f"./{path}"
-        with open(path, "rb") as f:
-            path = path.split("/")[-1]
-            return cls(name=path, content=f.read())
+        return cls(name=path.split("/")[-1], path=path)
+
+    @classmethod
+    def from_stream(cls, name: str, stream: BinaryIO):
+        return cls(name=name, stream=stream)
+
+    def open(self) -> BinaryIO:
+        """Returns a binary file object positioned at the start of the data.
+
+        A `stream` is handed back as is, so only close what you did not pass in.
+        """
+        if self.stream is not None:
+            if self.stream.seekable():
+                self.stream.seek(0)
+            return self.stream
+        if self.path is not None:
+            return open(self.path, "rb")
+        return BytesIO(self.content or b"")
+
+    def read_bytes(self) -> bytes:
+        if self.content is not None:
+            return self.content
+        source = self.open()
+        try:
+            return source.read()
+        finally:
+            if source is not self.stream:
+                source.close()
 
 
 class UserRequest(HumanMessage):
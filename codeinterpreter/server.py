@@ -0,0 +1,425 @@
+"""HTTP API in front of CodeInterpreter, for use behind a load balancer.
+
+    POST   /sessions                                 -> 201 {"session_id"}
+    DELETE /sessions/{session_id}
+    POST   /sessions/{session_id}/messages           -> 202 {"message_id"}
+           JSON {"content"}, or multipart with a "content" field and a "file" part
+    GET    /sessions/{session_id}/messages/{message_id}
+    GET    /sessions/{session_id}/events             server-sent events
+    GET    /sessions/{session_id}/artifacts/{name}
+    GET    /health
+
+Messages are queued and answered by a fixed number of workers. A full queue
+is answered with 429, a draining server with 503. Every session has its own
+kernel and its own directory below the workspace.
+"""
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Set
+from urllib.parse import quote
+from uuid import uuid4
+
+from aiohttp import web
+from langchain.callbacks.base import AsyncCallbackHandler
+from loguru import logger
+
+from codeinterpreter.artifacts import Artifact
+from codeinterpreter.code_interpreter import CodeInterpreter
+from codeinterpreter.custom_llm import get_transport
+from codeinterpreter.localbox import KernelPool, SessionRegistry
+from codeinterpreter.localbox.localbox import jupyter_file_path
+from codeinterpreter.schema import File
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class _Turn:
+    def __init__(self, session: "_Session", content: str, file: Optional[File]) -> None:
+        self.id = uuid4().hex
+        self.session = session
+        self.content = content
+        self.file = file
+        # queued -> running -> done
+        self.status = "queued"
+        self.response: Optional[Dict[str, Any]] = None
+        self.created = time.time()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"message_id": self.id, "status": self.status, "response": self.response}
+
+
+class _Session:
+    def __init__(self, history_size: int, turn_history: int) -> None:
+        self.id = uuid4().hex
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.turns: "OrderedDict[str, _Turn]" = OrderedDict()
+        self.turn_history = turn_history
+        self.artifacts: Dict[str, Artifact] = {}
+        self.pending = 0
+        self._event_ids = itertools.count(1)
+
+    def add_turn(self, turn: _Turn) -> None:
+        self.turns[turn.id] = turn
+        while len(self.turns) > self.turn_history:
+            self.turns.popitem(last=False)
+
+    def publish(self, event_type: str, **data: Any) -> None:
+        event = {"id": next(self._event_ids), "type": event_type, **data}
+        self.events.append(event)
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except asyncio.QueueFull:
+                # a client that cannot keep up is dropped rather than buffered
+                # without bound; it can reconnect with Last-Event-ID
+                self.disconnect(subscriber)
+
+    def disconnect(self, subscriber: asyncio.Queue) -> None:
+        self.subscribers.discard(subscriber)
+        while not subscriber.empty():
+            subscriber.get_nowait()
+        subscriber.put_nowait(None)
+
+
+class _EventRelay(AsyncCallbackHandler):
+    """Publishes the agent's tool calls of one turn as session events."""
+
+    def __init__(self, turn: _Turn) -> None:
+        self.turn = turn
+
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
+        self.turn.session.publish("code", message_id=self.turn.id, content=input_str)
+
+    async def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        self.turn.session.publish("output", message_id=self.turn.id, content=output)
+
+
+class CodeInterpreterServer:
+
+    def __init__(
+            self,
+            interpreter: CodeInterpreter,
+            workers: int = 4,
+            queue_size: int = 64,
+            max_pending_per_session: int = 4,
+            max_sessions: int = 1000,
+            max_upload_bytes: int = 512 * 1024 * 1024,
+            event_history: int = 200,
+            subscriber_buffer: int = 256,
+    ) -> None:
+        self.interpreter = interpreter
+        self.workers = workers
+        self.max_pending_per_session = max_pending_per_session
+        self.max_sessions = max_sessions
+        self.max_upload_bytes = max_upload_bytes
+        self.event_history = event_history
+        self.subscriber_buffer = subscriber_buffer
+        self.sessions: Dict[str, _Session] = {}
+        self._queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: list = []
+        self._busy = 0
+        self._accepting = False
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.post("/sessions", self.create_session),
+            web.delete("/sessions/{session_id}", self.delete_session),
+            web.post("/sessions/{session_id}/messages", self.submit_message),
+            web.get("/sessions/{session_id}/messages/{message_id}", self.get_message),
+            web.get("/sessions/{session_id}/events", self.events),
+            web.get("/sessions/{session_id}/artifacts/{name:.+}", self.download_artifact),
+            web.get("/health", self.health),
+        ])
+        app.on_startup.append(self._start)
+        app.on_shutdown.append(self._shutdown)
+        return app
+
+    async def _start(self, app: web.Application) -> None:
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"turn-worker-{i}")
+            for i in range(self.workers)
+        ]
+        self._accepting = True
+
+    async def _shutdown(self, app: web.Application) -> None:
+        self._accepting = False
+        for session in self.sessions.values():
+            for subscriber in list(session.subscribers):
+                session.disconnect(subscriber)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.interpreter.sessions.close)
+        await get_transport().aclose()
+
+    async def create_session(self, request: web.Request) -> web.Response:
+        self._check_accepting()
+        if len(self.sessions) >= self.max_sessions:
+            raise _too_many("Too many sessions")
+        session = _Session(self.event_history, self.turn_history)
+        self.sessions[session.id] = session
+        logger.info("Created session {}", session.id)
+        return web.json_response({"session_id": session.id}, status=201)
+
+    async def delete_session(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        if session.pending:
+            raise web.HTTPConflict(text="The session still has messages in progress")
+        del self.sessions[session.id]
+        for subscriber in list(session.subscribers):
+            session.disconnect(subscriber)
+
+        registry = self.interpreter.sessions
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, registry.evict, session.id, False)
+        workspace = registry.workspace(session.id)
+        if workspace is not None:
+            await loop.run_in_executor(None, shutil.rmtree, workspace, True)
+        logger.info("Deleted session {}", session.id)
+        return web.Response(status=204)
+
+    async def submit_message(self, request: web.Request) -> web.Response:
+        self._check_accepting()
+        session = self._session(request)
+        if session.pending >= self.max_pending_per_session:
+            raise _too_many("Too many messages in progress for this session")
+        if self._queue.full():
+            raise _too_many("The server is busy")
+
+        content, file = await self._read_message(request)
+        turn = _Turn(session, content, file)
+        # checked again: reading an upload may have taken a while
+        try:
+            self._queue.put_nowait(turn)
+        except asyncio.QueueFull:
+            _close_file(file)
+            raise _too_many("The server is busy")
+        session.pending += 1
+        session.add_turn(turn)
+        session.publish("queued", message_id=turn.id)
+        return web.json_response(
+            {"message_id": turn.id, "queue_position": self._queue.qsize()}, status=202
+        )
+
+    async def get_message(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        turn = session.turns.get(request.match_info["message_id"])
+        if turn is None:
+            raise web.HTTPNotFound(text="Unknown message")
+        return web.json_response(turn.to_json())
+
+    async def events(self, request: web.Request) -> web.StreamResponse:
+        session = self._session(request)
+        try:
+            last_id = int(request.headers.get("Last-Event-ID", "0"))
+        except ValueError:
+            last_id = 0
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+
+        # subscribe before replaying so nothing published in between is missed
+        subscriber: asyncio.Queue = asyncio.Queue(maxsize=self.subscriber_buffer)
+        session.subscribers.add(subscriber)
+        try:
+            for event in list(session.events):
+                if event["id"] > last_id:
+                    last_id = await _send_event(response, event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.get(), 15)
+                except asyncio.TimeoutError:
+                    # keeps proxies from closing an idle stream
+                    await response.write(b": keep-alive\n\n")
+                    continue
+                if event is None:
+                    break
+                if event["id"] > last_id:
+                    last_id = await _send_event(response, event)
+        except ConnectionResetError:
+            pass
+        finally:
+            session.subscribers.discard(subscriber)
+        return response
+
+    async def download_artifact(self, request: web.Request) -> web.StreamResponse:
+        session = self._session(request)
+        artifact = session.artifacts.get(request.match_info["name"])
+        if artifact is None or not os.path.isfile(artifact.path):
+            raise web.HTTPNotFound(text="Unknown artifact")
+        return web.FileResponse(
+            artifact.path,
+            chunk_size=CHUNK_SIZE,
+            headers={
+                "ETag": f'"{artifact.sha256}"',
+                "Content-Disposition": f"attachment; filename*=UTF-8''{quote(os.path.basename(artifact.name))}",
+            },
+        )
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "accepting": self._accepting,
+            "sessions": len(self.sessions),
+            "kernels": len(self.interpreter.sessions.keys()),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "busy_workers": self._busy,
+            "workers": self.workers,
+        })
+
+    @property
+    def turn_history(self) -> int:
+        return max(self.max_pending_per_session * 4, 16)
+
+    def _check_accepting(self) -> None:
+        if not self._accepting:
+            raise web.HTTPServiceUnavailable(text="The server is shutting down")
+
+    def _session(self, request: web.Request) -> _Session:
+        session = self.sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text="Unknown session")
+        return session
+
+    async def _read_message(self, request: web.Request):
+        if not request.content_type.startswith("multipart/"):
+            try:
+                body = await request.json()
+                content = body["content"]
+            except (ValueError, KeyError, TypeError):
+                raise web.HTTPBadRequest(text='Expected a JSON body with "content"')
+            return str(content), None
+
+        content, file = "", None
+        reader = await request.multipart()
+        try:
+            async for part in reader:
+                if part.name == "content":
+                    content = await part.text()
+                elif part.name == "file" and part.filename and file is None:
+                    file = await self._spool_upload(part)
+        except BaseException:
+            _close_file(file)
+            raise
+        return content, file
+
+    async def _spool_upload(self, part) -> File:
+        # small uploads stay in memory, larger ones go to a temporary file
+        spool = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+        size = 0
+        try:
+            while chunk := await part.read_chunk(CHUNK_SIZE):
+                size += len(chunk)
+                if size > self.max_upload_bytes:
+                    raise web.HTTPRequestEntityTooLarge(
+                        max_size=self.max_upload_bytes, actual_size=size
+                    )
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return File.from_stream(os.path.basename(part.filename), spool)
+
+    async def _worker(self) -> None:
+        while True:
+            turn = await self._queue.get()
+            self._busy += 1
+            try:
+                await self._run_turn(turn)
+            except Exception as e:
+                logger.exception("Turn {} failed: {}", turn.id, e)
+            finally:
+                self._busy -= 1
+                turn.session.pending -= 1
+                _close_file(turn.file)
+                turn.file = None
+                self._queue.task_done()
+
+    async def _run_turn(self, turn: _Turn) -> None:
+        session = turn.session
+        turn.status = "running"
+        session.publish("started", message_id=turn.id)
+        try:
+            response = await self.interpreter.agenerate_response(
+                turn.content,
+                turn.file,
+                session_id=session.id,
+                callbacks=[_EventRelay(turn)],
+            )
+        except BaseException:
+            turn.status = "failed"
+            session.publish("failed", message_id=turn.id)
+            raise
+
+        files = []
+        for artifact in response.files:
+            session.artifacts[artifact.name] = artifact
+            files.append({
+                "name": artifact.name,
+                "size": artifact.size,
+                "sha256": artifact.sha256,
+                "url": f"/sessions/{session.id}/artifacts/{quote(artifact.name)}",
+            })
+        turn.response = {"content": response.content, "files": files}
+        turn.status = "done"
+        session.publish("response", message_id=turn.id, **turn.response)
+
+
+async def _send_event(response: web.StreamResponse, event: Dict[str, Any]) -> int:
+    data = json.dumps(event, ensure_ascii=False)
+    await response.write(
+        f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n".encode("utf-8")
+    )
+    return event["id"]
+
+
+def _too_many(text: str) -> web.HTTPTooManyRequests:
+    return web.HTTPTooManyRequests(text=text, headers={"Retry-After": "1"})
+
+
+def _close_file(file: Optional[File]) -> None:
+    if file is not None and file.stream is not None:
+        file.stream.close()
+
+
+def main() -> None:
+    kernel_pool = KernelPool(
+        min_size=int(os.getenv("KERNEL_POOL_MIN_SIZE", "1")),
+        max_size=int(os.getenv("KERNEL_POOL_MAX_SIZE", "4")),
+    )
+    sessions = SessionRegistry(
+        kernel_pool=kernel_pool,
+        max_sessions=kernel_pool.max_size,
+        idle_timeout=float(os.getenv("SESSION_IDLE_TIMEOUT", "1800")),
+        max_memory_percent=float(os.getenv("SESSION_MAX_MEMORY_PERCENT", "85")),
+        workspace_root=os.path.join(jupyter_file_path, "sessions"),
+    )
+    server = CodeInterpreterServer(
+        CodeInterpreter(sessions=sessions),
+        workers=int(os.getenv("SERVER_WORKERS", str(kernel_pool.max_size))),
+        queue_size=int(os.getenv("SERVER_QUEUE_SIZE", "64")),
+        max_pending_per_session=int(os.getenv("SERVER_MAX_PENDING_PER_SESSION", "4")),
+        max_sessions=int(os.getenv("SERVER_MAX_SESSIONS", "1000")),
+    )
+    web.run_app(
+        server.app(),
+        host=os.getenv("SERVER_HOST", "0.0.0.0"),
+        port=int(os.getenv("SERVER_PORT", "8080")),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -42,9 +42,9 @@ plt.savefig('random_points.png')
 # )
 
 # check output type
-if output.type == "image/png":
-    print("This should not happen")
-elif output.type == "error":
+for file_name in output.files:
+    print("Rich output saved to: ", file_name)
+if output.type == "error":
     print("Error: ", output.content)
 else:
     for file in list_files():